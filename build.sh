@@ -14,4 +14,7 @@ python manage.py collectstatic --noinput
 # Run migrations
 python manage.py migrate
 
+# Table for CACHE_BACKEND=db; does nothing for other backends
+python manage.py createcachetable
+
 echo "Build completed successfully!"
\ No newline at end of file
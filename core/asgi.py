@@ -14,3 +14,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
 application = get_asgi_application()
+
+# Refuses oversized request bodies before Django spools them; imported once
+# the application above has set Django up
+from mainapp.uploads import RequestBodyLimit  # noqa: E402
+
+application = RequestBodyLimit(application)
@@ -12,10 +12,12 @@ https://docs.djangoproject.com/en/6.0/ref/settings/
 
 from pathlib import Path
 import os
+import sys
 import dj_database_url
-from decouple import config
+from decouple import Csv, config
 
 from django.conf.global_settings import STATICFILES_DIRS
+from django.core.exceptions import ImproperlyConfigured
 # from starlette.staticfiles import StaticFiles
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -49,6 +51,9 @@ AUTH_USER_MODEL = 'mainapp.Users'
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'mainapp.middleware.QueryInstrumentationMiddleware',
+    'mainapp.middleware.OverloadMiddleware',
+    'mainapp.middleware.ReplicaPinMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -64,8 +69,18 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # Compile each template once per process and keep it, rather than
+            # re-reading and re-parsing it from disk on every render, whatever
+            # DEBUG is (the development server's autoreloader clears the cache
+            # when a template changes). `manage.py warm_templates` compiles
+            # them all up front; gunicorn does so before forking its workers.
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
@@ -88,6 +103,98 @@ DATABASES = {
     )
 }
 
+# SQLite tuning for single-node deployments. WAL lets readers carry on while
+# one connection writes, and synchronous=NORMAL is durable in WAL mode short
+# of a power loss. Write transactions start IMMEDIATE, taking the write lock
+# up front: a deferred transaction that reads first and then writes can't
+# wait for the lock and fails at once with "database is locked".
+# SQLITE_BUSY_TIMEOUT is how many seconds a connection waits for the lock.
+SQLITE_OPTIONS = {
+    'transaction_mode': 'IMMEDIATE',
+    'timeout': config('SQLITE_BUSY_TIMEOUT', default=20, cast=int),
+    'init_command': ';'.join([
+        f"PRAGMA journal_mode={config('SQLITE_JOURNAL_MODE', default='WAL')}",
+        f"PRAGMA synchronous={config('SQLITE_SYNCHRONOUS', default='NORMAL')}",
+        f"PRAGMA mmap_size={config('SQLITE_MMAP_SIZE', default=256 * 1024 * 1024, cast=int)}",
+        # Negative sizes are in KiB rather than pages
+        f"PRAGMA cache_size=-{config('SQLITE_CACHE_SIZE_KB', default=64 * 1024, cast=int)}",
+        'PRAGMA temp_store=MEMORY',
+    ]),
+}
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default'].setdefault('OPTIONS', {}).update(SQLITE_OPTIONS)
+
+# Read replicas, as a comma-separated list of database URLs. Views marked
+# @replica_reads read from them (see mainapp.routers), except for
+# REPLICA_PIN_SECONDS after the client writes anything, and skip a replica
+# for REPLICA_RETRY_SECONDS after failing to connect to it.
+DATABASE_REPLICAS = []
+for _number, _url in enumerate(config('DATABASE_REPLICA_URLS', default='', cast=Csv()), 1):
+    _replica = dj_database_url.parse(_url, conn_max_age=600)
+    if _replica['ENGINE'] == 'django.db.backends.sqlite3':
+        _replica.setdefault('OPTIONS', {}).update(SQLITE_OPTIONS)
+    # Tests read from the primary instead
+    _replica['TEST'] = {'MIRROR': 'default'}
+    DATABASES[f'replica{_number}'] = _replica
+    DATABASE_REPLICAS.append(f'replica{_number}')
+DATABASE_ROUTERS = ['mainapp.routers.ReplicaRouter']
+REPLICA_PIN_SECONDS = config('REPLICA_PIN_SECONDS', default=10, cast=int)
+REPLICA_RETRY_SECONDS = config('REPLICA_RETRY_SECONDS', default=30, cast=int)
+
+
+# Cache: CACHE_BACKEND is 'locmem' (per process), 'file' (a directory
+# shared by the processes on one machine, CACHE_LOCATION) or 'db' (a table,
+# created with `manage.py createcachetable`). With several worker processes
+# pick a shared backend, or fragments invalidated in one process may still
+# be served by another until FRAGMENT_CACHE_TIMEOUT runs out.
+CACHE_BACKENDS = {
+    'locmem': ('django.core.cache.backends.locmem.LocMemCache', 'digisigner'),
+    'file': ('django.core.cache.backends.filebased.FileBasedCache', str(BASE_DIR / '.cache')),
+    'db': ('django.core.cache.backends.db.DatabaseCache', 'django_cache'),
+}
+CACHE_BACKEND = config('CACHE_BACKEND', default='locmem')
+_cache_backend, _cache_location = CACHE_BACKENDS[CACHE_BACKEND]
+CACHES = {
+    'default': {
+        'BACKEND': _cache_backend,
+        'LOCATION': config('CACHE_LOCATION', default=_cache_location),
+        'TIMEOUT': config('CACHE_TIMEOUT', default=300, cast=int),
+        'KEY_PREFIX': 'digisigner',
+        'OPTIONS': {'MAX_ENTRIES': config('CACHE_MAX_ENTRIES', default=5000, cast=int)},
+    }
+}
+FRAGMENT_CACHE_TIMEOUT = config('FRAGMENT_CACHE_TIMEOUT', default=300, cast=int)
+
+# Sessions: SESSION_BACKEND 'db' stores them in the database table;
+# 'cached_db' reads them from the cache in front of it, and 'cache' and
+# 'signed_cookies' (stored in the signed, client-readable cookie) are the
+# other engines Django ships. CACHE_AUTH keeps session users in the cache
+# (mainapp.auth.CachedModelBackend) rather than loading them per request.
+#
+# Both are only safe with a cache every worker process shares: logging out,
+# changing a password or deactivating a user must end the session in all of
+# them, not just in the one that handled the request. So they default to
+# the database with the per-process 'locmem' cache, and combining them with
+# it under several workers is refused.
+_shared_cache = CACHE_BACKEND != 'locmem'
+SESSION_ENGINE = 'django.contrib.sessions.backends.' + config(
+    'SESSION_BACKEND', default='cached_db' if _shared_cache else 'db',
+)
+CACHE_AUTH = config('CACHE_AUTH', default=_shared_cache, cast=bool)
+if (
+    not _shared_cache
+    and config('WEB_CONCURRENCY', default=1, cast=int) > 1
+    and (CACHE_AUTH or SESSION_ENGINE.endswith(('.cache', '.cached_db')))
+):
+    raise ImproperlyConfigured(
+        'Cached sessions and users need a CACHE_BACKEND shared by all worker processes, not locmem.'
+    )
+AUTHENTICATION_BACKENDS = [
+    'mainapp.auth.CachedModelBackend' if CACHE_AUTH else 'django.contrib.auth.backends.ModelBackend',
+]
+# Cached session users and dashboard profiles are kept for this long
+AUTH_CACHE_TIMEOUT = config('AUTH_CACHE_TIMEOUT', default=300, cast=int)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -134,3 +241,92 @@ MEDIA_URL = '/media/'
 # absolute filesystem path where uploaded files are stored
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Largest PDF accepted for upload or verification, unless the user or API
+# token has its own max_upload_bytes.
+PDF_UPLOAD_MAX_BYTES = config('PDF_UPLOAD_MAX_BYTES', default=100 * 1024 * 1024, cast=int)
+
+# Resumable (tus) uploads: staging area for uploads in progress and the
+# size limit when the user or token has none of its own. An upload expires
+# CHUNKED_UPLOAD_EXPIRY_SECONDS after its last part; run
+# `manage.py expire_chunked_uploads` periodically to remove abandoned ones.
+CHUNKED_UPLOAD_DIR = config('CHUNKED_UPLOAD_DIR', default=str(MEDIA_ROOT / 'staging'))
+CHUNKED_UPLOAD_MAX_BYTES = config('CHUNKED_UPLOAD_MAX_BYTES', default=2 * 1024 * 1024 * 1024, cast=int)
+CHUNKED_UPLOAD_EXPIRY_SECONDS = config('CHUNKED_UPLOAD_EXPIRY_SECONDS', default=24 * 60 * 60, cast=int)
+
+# Under ASGI, request bodies over REQUEST_BODY_MAX_BYTES (for the resumable
+# upload API, CHUNKED_UPLOAD_MAX_BYTES) are refused with 413 before Django
+# reads them (mainapp.uploads.RequestBodyLimit). Keep it at least as large
+# as any user's or API token's max_upload_bytes. A proxy in front, e.g.
+# nginx's client_max_body_size, can refuse them before they reach the app.
+REQUEST_BODY_MAX_BYTES = config('REQUEST_BODY_MAX_BYTES', default=PDF_UPLOAD_MAX_BYTES + 64 * 1024, cast=int)
+
+# Resolution uploaded signature images are downsampled to for embedding
+SIGNATURE_RENDER_DPI = config('SIGNATURE_RENDER_DPI', default=300, cast=int)
+
+# Threads that async views hand blocking work (queries, parsing, hashing,
+# PDF and crypto work) to. Each may hold a database connection of its own.
+BLOCKING_WORKERS = config('BLOCKING_WORKERS', default=16, cast=int)
+
+# CPU-heavy work (PDF stamping, RSA signing and verification) runs on
+# CPU_WORKERS threads per process. It holds the GIL, so more threads don't
+# add throughput - more server processes (WEB_CONCURRENCY) do - and only
+# make each task finish later. Up to CPU_QUEUE_SIZE more tasks wait for a
+# thread, and requests beyond that get a 503 asking the client to retry
+# after CPU_RETRY_AFTER seconds.
+CPU_WORKERS = config('CPU_WORKERS', default=1, cast=int)
+CPU_QUEUE_SIZE = config('CPU_QUEUE_SIZE', default=8, cast=int)
+CPU_RETRY_AFTER = config('CPU_RETRY_AFTER', default=5, cast=int)
+
+# Signed document downloads: '' streams from Django, 'xsendfile' hands the
+# path to Apache/lighttpd, 'xaccel' redirects nginx to an internal location
+# mapped to MEDIA_ROOT at SENDFILE_URL_PREFIX.
+SENDFILE_BACKEND = config('SENDFILE_BACKEND', default='')
+SENDFILE_URL_PREFIX = config('SENDFILE_URL_PREFIX', default='/protected-media/')
+
+STORAGES = {
+    # Uploaded and signed files are stored once per distinct content under
+    # media/blobs/; run `manage.py migrate_media_to_blobs` for older files.
+    'default': {
+        'BACKEND': config('MEDIA_STORAGE_BACKEND', default='mainapp.storage.ContentAddressedStorage'),
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
+
+# SQL instrumentation
+# Per-request query count and SQL time, reported in the Server-Timing header
+# and the 'mainapp.sql' logger.
+SQL_INSTRUMENTATION_ENABLED = config('SQL_INSTRUMENTATION_ENABLED', default=True, cast=bool)
+SQL_DUPLICATE_QUERY_THRESHOLD = config('SQL_DUPLICATE_QUERY_THRESHOLD', default=3, cast=int)
+
+# Signing pipeline timing (mainapp.timing)
+# Requests slower than the threshold (seconds) are logged as warnings; if a
+# profile directory is set, their sampled stacks are written there too.
+SIGNING_SLOW_THRESHOLD = config('SIGNING_SLOW_THRESHOLD', default=2.0, cast=float)
+SIGNING_PROFILE_DIR = config('SIGNING_PROFILE_DIR', default='') or None
+SIGNING_PROFILE_INTERVAL = config('SIGNING_PROFILE_INTERVAL', default=0.005, cast=float)
+
+# Prometheus metrics (/metrics). Set PROMETHEUS_MULTIPROC_DIR in the
+# environment to merge values across gunicorn workers; set METRICS_TOKEN to
+# require "Authorization: Bearer <token>" on scrapes.
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+
+# mainapp logs each request's queries and timings at INFO. Under the test
+# runner only warnings are shown unless MAINAPP_LOG_LEVEL asks for more.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'mainapp': {
+            'handlers': ['console'],
+            'level': config('MAINAPP_LOG_LEVEL', default='WARNING' if sys.argv[1:2] == ['test'] else 'INFO'),
+        },
+    },
+}
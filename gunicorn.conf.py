@@ -0,0 +1,132 @@
+"""
+Gunicorn configuration for serving DigiSigner over ASGI.
+
+gunicorn loads this file automatically from the working directory. Workers
+and threads are sized from the CPUs and memory available to the container;
+WEB_CONCURRENCY and BLOCKING_WORKERS in the environment override the
+computed values. The application is imported once in the master and
+forked, so ReportLab, pypdf and cryptography are shared copy-on-write
+instead of being imported by every worker.
+"""
+import os
+
+from prometheus_client import multiprocess
+
+# Memory a worker needs before it serves anything, and each thread of its
+# blocking-work pool may add while handling a request (buffered uploads,
+# parsed PDF objects, rendered overlays)
+WORKER_BASE_MB = int(os.environ.get('GUNICORN_WORKER_BASE_MB', 160))
+THREAD_MB = int(os.environ.get('GUNICORN_THREAD_MB', 16))
+
+
+def _available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _available_memory_mb():
+    # The container's cgroup limit (v2, then v1) when there is one
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < 2**60:
+            return int(value) // 2**20
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2**20
+
+
+_cpus = _available_cpus()
+_memory_mb = _available_memory_mb()
+
+# One event loop per core: waiting on clients costs no thread, and blocking
+# and CPU-bound work is handed to each worker's pools. Stamping and signing
+# hold the GIL, so these processes are what put the cores to use. Fewer
+# when memory can't hold that many.
+workers = int(os.environ.get('WEB_CONCURRENCY') or max(min(_cpus, _memory_mb // (WORKER_BASE_MB + 4 * THREAD_MB)), 1))
+
+# Each worker's blocking-work pool gets what its share of memory allows
+threads = int(
+    os.environ.get('BLOCKING_WORKERS')
+    or min(max((_memory_mb // workers - WORKER_BASE_MB) // THREAD_MB, 4), 32)
+)
+
+# Django settings read these when the app is preloaded below, so the
+# blocking pool gets the thread count and settings can check the cache is
+# fit for several processes
+os.environ['WEB_CONCURRENCY'] = str(workers)
+os.environ['BLOCKING_WORKERS'] = str(threads)
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+worker_class = 'uvicorn_worker.UvicornWorker'
+preload_app = True
+
+# Recycle workers now and then to return memory fragmented by large PDFs;
+# the jitter keeps them from all restarting at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+
+# Signing a large document can take tens of seconds, so allow well beyond
+# that before a worker is considered stuck, and let in-flight signings
+# finish when one is recycled or the server restarts
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 60
+keepalive = 5
+
+# Heartbeat files in memory rather than on a possibly slow disk
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+accesslog = '-'
+
+
+def on_starting(server):
+    # Metric files left by a previous run would be merged into this one's
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory and os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.endswith('.db'):
+                os.remove(os.path.join(directory, name))
+    server.log.info('Sized for %d CPUs and %d MB: %d workers, %d threads each', _cpus, _memory_mb, workers, threads)
+
+
+def when_ready(server):
+    # The app loads its heavy libraries on first use so that commands and
+    # unpreloaded workers start quickly; here, load them once for every
+    # worker to share
+    from mainapp import templating, utils
+    utils.import_lazy_modules()
+    # Likewise compile the templates into the cached loader
+    compiled, errors = templating.warm_templates()
+    server.log.info('compiled %d templates', len(compiled))
+    for name, error in errors.items():
+        server.log.warning('template %s does not compile: %s', name, error)
+
+
+def pre_fork(server, worker):
+    # Close any database or cache connection the preloaded app opened, so
+    # that workers don't inherit and share the master's sockets
+    from django.core.cache import caches
+    from django.db import connections
+    connections.close_all()
+    caches.close_all()
+
+
+def post_fork(server, worker):
+    from django.db import connections
+
+    from mainapp import offload, timing
+
+    # Start the worker with fresh state: no connections (there should be
+    # none after pre_fork), thread pools rebuilt on first use since their
+    # threads didn't survive the fork, and its own stage timings
+    connections.close_all()
+    offload.reset()
+    timing.reset()
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
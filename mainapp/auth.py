@@ -0,0 +1,84 @@
+"""
+Authentication without a database query per request.
+
+CachedModelBackend keeps session users in the cache, and user_profile()
+keeps the few facts about a user that pages show on every view (whether
+they have keys and a signature). The signal handlers in mainapp.signals
+drop the entries when the underlying rows change.
+
+A cached user that other processes don't see dropped would keep a
+logged-out or deactivated session alive there, so settings only selects
+CachedModelBackend (CACHE_AUTH) with a cache shared between processes.
+Profiles are only shown, and may lag by up to AUTH_CACHE_TIMEOUT seconds
+in other processes with the local-memory cache.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+
+from . import metrics
+from .routers import primary_reads, track_reads
+
+
+def _user_key(user_id):
+    return f'auth-user:{user_id}'
+
+
+def _profile_key(user_id):
+    return f'user-profile:{user_id}'
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ModelBackend that loads the session's user from the cache.
+    """
+
+    def get_user(self, user_id):
+        key = _user_key(user_id)
+        user = cache.get(key)
+        metrics.record_cache('auth_user', user is not None)
+        if user is None:
+            with primary_reads():
+                user = super().get_user(user_id)
+            if user is not None:
+                cache.set(key, user, settings.AUTH_CACHE_TIMEOUT)
+            return user
+        return user if self.user_can_authenticate(user) else None
+
+    async def aget_user(self, user_id):
+        return await sync_to_async(self.get_user)(user_id)
+
+
+def forget_user(user_id):
+    cache.delete(_user_key(user_id))
+
+
+def user_profile(request):
+    """
+    {'has_keys': ..., 'has_signature': ...} for the request's user, looked
+    up at most once per request and otherwise cached.
+    """
+    profile = getattr(request, '_user_profile', None)
+    if profile is not None:
+        return profile
+
+    from .models import Signature, UserKey
+
+    user = request.user
+    key = _profile_key(user.pk)
+    profile = cache.get(key)
+    metrics.record_cache('user_profile', profile is not None)
+    if profile is None:
+        with track_reads() as reads:
+            profile = {
+                'has_keys': UserKey.objects.filter(user=user).exists(),
+                'has_signature': Signature.objects.filter(user=user).exists(),
+            }
+        cache.set(key, profile, reads.cache_timeout(settings.AUTH_CACHE_TIMEOUT))
+    request._user_profile = profile
+    return profile
+
+
+def forget_profile(user_id):
+    cache.delete(_profile_key(user_id))
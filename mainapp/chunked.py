@@ -0,0 +1,234 @@
+"""
+Resumable chunked uploads, following the core tus 1.0 protocol plus its
+creation, termination and checksum (sha256) extensions.
+
+Each PATCH appends one part to a staging file under CHUNKED_UPLOAD_DIR,
+hashing it as it is written. When the last byte arrives the staging file
+becomes the Document's file as-is, so the parts are never copied or
+assembled again.
+
+Uploads that receive no part for CHUNKED_UPLOAD_EXPIRY_SECONDS expire
+(the tus expiration extension). They are refused from then on, and
+expire_uploads() removes them along with their staging files.
+"""
+import base64
+import binascii
+import hashlib
+import os
+from collections import OrderedDict
+from datetime import timedelta
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, parts aren't serialised
+    fcntl = None
+
+from django.conf import settings
+from django.utils import timezone
+
+from .uploads import HEADER_WINDOW, TRAILER_WINDOW, is_pdf_header, is_pdf_trailer
+from .utils import StagedFile, calculate_hash
+
+TUS_VERSION = '1.0.0'
+TUS_EXTENSIONS = 'creation,expiration,termination,checksum'
+CHUNK_SIZE = 64 * 1024
+
+# Whole-file SHA256 state for uploads whose parts arrived in this process,
+# so completion doesn't need to read the file back. hashlib objects can't
+# be shared between workers; uploads continued elsewhere are hashed once at
+# completion instead.
+MAX_RUNNING_HASHES = 256
+_running_hashes = OrderedDict()
+
+
+class ChunkError(ValueError):
+    """
+    A part was rejected; ``status`` is the HTTP status to answer with.
+    """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def staging_path(upload):
+    return os.path.join(settings.CHUNKED_UPLOAD_DIR, f'{upload.upload_id}.part')
+
+
+def expires_at(upload):
+    """
+    When ``upload`` expires unless another part arrives.
+    """
+    return upload.updated_at + timedelta(seconds=settings.CHUNKED_UPLOAD_EXPIRY_SECONDS)
+
+
+def is_expired(upload):
+    return upload.document_id is None and expires_at(upload) <= timezone.now()
+
+
+def expire_uploads():
+    """
+    Delete unfinished uploads that have expired, and staging files left
+    without an upload for as long. Returns how many of each were removed.
+    """
+    from .models import ChunkedUpload
+
+    cutoff = timezone.now() - timedelta(seconds=settings.CHUNKED_UPLOAD_EXPIRY_SECONDS)
+    expired = ChunkedUpload.objects.filter(document__isnull=True, updated_at__lte=cutoff)
+    uploads = 0
+    for upload in expired.iterator():
+        discard(upload)
+        upload.delete()
+        uploads += 1
+
+    orphans = 0
+    if os.path.isdir(settings.CHUNKED_UPLOAD_DIR):
+        active = {
+            f'{upload_id}.part'
+            for upload_id in ChunkedUpload.objects.filter(document__isnull=True).values_list('upload_id', flat=True)
+        }
+        for entry in os.scandir(settings.CHUNKED_UPLOAD_DIR):
+            if (
+                entry.name.endswith('.part') and entry.name not in active
+                and entry.stat().st_mtime <= cutoff.timestamp()
+            ):
+                os.remove(entry.path)
+                orphans += 1
+    return uploads, orphans
+
+
+def parse_metadata(header):
+    """
+    Decode an Upload-Metadata header: comma-separated "key base64value" pairs.
+    """
+    metadata = {}
+    for pair in filter(None, (p.strip() for p in (header or '').split(','))):
+        key, _, value = pair.partition(' ')
+        try:
+            metadata[key] = base64.b64decode(value).decode() if value else ''
+        except (binascii.Error, UnicodeDecodeError):
+            raise ChunkError(f'Invalid Upload-Metadata value for {key}.')
+    return metadata
+
+
+def parse_checksum(header):
+    """
+    Return the expected digest from an "Upload-Checksum: sha256 <base64>"
+    header, or None if there is none.
+    """
+    if not header:
+        return None
+    algorithm, _, value = header.partition(' ')
+    if algorithm != 'sha256':
+        raise ChunkError('Only sha256 checksums are supported.', status=400)
+    try:
+        return base64.b64decode(value)
+    except binascii.Error:
+        raise ChunkError('Invalid Upload-Checksum value.')
+
+
+def _running_hash(upload):
+    state = _running_hashes.pop(upload.upload_id, None)
+    if state is None and upload.offset == 0:
+        state = (0, hashlib.sha256())
+    if state is None or state[0] != upload.offset:
+        return None
+    return state[1]
+
+
+def _remember_hash(upload, sha256):
+    _running_hashes[upload.upload_id] = (upload.offset, sha256)
+    while len(_running_hashes) > MAX_RUNNING_HASHES:
+        _running_hashes.popitem(last=False)
+
+
+def append_part(upload, stream, length, offset, expected_checksum=None):
+    """
+    Append ``length`` bytes read from ``stream`` to the upload, which the
+    client says is at ``offset``, and save the new offset. Returns the
+    part's SHA256 hex digest.
+    """
+    path = staging_path(upload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'ab') as out:
+        if fcntl is not None:
+            try:
+                fcntl.flock(out, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise ChunkError('Another request is writing to this upload.', status=423)
+
+        # Re-read under the lock: another request may have just appended
+        upload.refresh_from_db(fields=['offset', 'part_hashes'])
+        if offset != upload.offset:
+            raise ChunkError('Upload-Offset does not match the current offset.', status=409)
+        if upload.offset + length > upload.length:
+            raise ChunkError('Part extends past Upload-Length.', status=413)
+
+        # Drop anything left over from an interrupted earlier attempt
+        out.truncate(upload.offset)
+        part_hash = hashlib.sha256()
+        file_hash = _running_hash(upload)
+        head = b''
+        remaining = length
+        while remaining > 0:
+            chunk = stream.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            if upload.offset == 0 and len(head) < HEADER_WINDOW:
+                head += chunk[:HEADER_WINDOW - len(head)]
+            part_hash.update(chunk)
+            if file_hash is not None:
+                file_hash.update(chunk)
+            out.write(chunk)
+            remaining -= len(chunk)
+
+        failure = None
+        if remaining:
+            failure = ChunkError('Request body ended before Content-Length bytes.')
+        elif expected_checksum is not None and part_hash.digest() != expected_checksum:
+            failure = ChunkError('Checksum mismatch.', status=460)
+        elif upload.offset == 0 and not is_pdf_header(head):
+            failure = ChunkError('File is not a PDF document.', status=415)
+        if failure:
+            out.truncate(upload.offset)
+            raise failure
+
+        upload.offset += length
+        upload.part_hashes = upload.part_hashes + [part_hash.hexdigest()]
+        upload.save(update_fields=['offset', 'part_hashes', 'updated_at'])
+        if file_hash is not None:
+            _remember_hash(upload, file_hash)
+    return part_hash.hexdigest()
+
+
+def complete(upload):
+    """
+    Turn a fully received upload into a Document. The staging file is
+    handed to storage to move into place.
+    """
+    from .models import Document
+
+    path = staging_path(upload)
+    with open(path, 'rb') as f:
+        f.seek(max(upload.length - TRAILER_WINDOW, 0))
+        if not is_pdf_trailer(f.read(TRAILER_WINDOW)):
+            raise ChunkError('PDF document is truncated or corrupt.', status=415)
+
+    state = _running_hashes.pop(upload.upload_id, None)
+    if state is not None and state[0] == upload.length:
+        digest = state[1].hexdigest()
+    else:
+        digest = calculate_hash(path)
+
+    document = Document(user=upload.user, title=upload.title, original_hash=digest)
+    document.file.save(upload.filename, StagedFile(path, sha256=digest), save=False)
+    document.save()
+    return document
+
+
+def discard(upload):
+    _running_hashes.pop(upload.upload_id, None)
+    path = staging_path(upload)
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,140 @@
+"""
+Serving stored files: conditional requests, byte ranges and offloading
+the transfer to the front server.
+
+SENDFILE_BACKEND selects the offload: 'xsendfile' (Apache mod_xsendfile,
+lighttpd) sends the absolute path in X-Sendfile, 'xaccel' (nginx) sends
+SENDFILE_URL_PREFIX + the storage name in X-Accel-Redirect. Leave it
+empty to stream the file from Django.
+"""
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, quote_etag
+
+from .offload import run_blocking
+
+CHUNK_SIZE = 64 * 1024
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header, size):
+    """
+    Parse a single-range Range header into an inclusive (start, end) pair.
+
+    Returns None when the header should be ignored (missing, malformed or
+    multi-range, which we answer with the whole file) and raises ValueError
+    when the range cannot be satisfied.
+    """
+    if not header:
+        return None
+    match = _RANGE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError('Empty suffix range')
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError('Range not satisfiable')
+    return start, end
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+async def _aread_range(path, start, length):
+    # Each read runs on the blocking-work pool; the event loop only waits
+    f = await run_blocking(open, path, 'rb')
+    try:
+        await run_blocking(f.seek, start)
+        while length > 0:
+            chunk = await run_blocking(f.read, min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await run_blocking(f.close)
+
+
+def serve_file(request, field_file, etag=None, last_modified=None, filename=None, as_attachment=True, asynchronous=False):
+    """
+    Return a response for ``field_file``, answering conditional requests
+    with 304/412 and Range requests with 206 when Django streams it.
+    ``last_modified`` is a Unix timestamp. With ``asynchronous`` the body
+    is an async iterator, for async views under ASGI.
+    """
+    etag = quote_etag(etag) if etag else None
+    # HTTP dates have whole seconds: compared with a fractional timestamp,
+    # the If-Modified-Since a client echoes back would never match
+    last_modified = int(last_modified) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        return response
+
+    path = field_file.path
+    filename = filename or os.path.basename(field_file.name)
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    backend = getattr(settings, 'SENDFILE_BACKEND', '')
+
+    if backend:
+        # The front server does the transfer, ranges included
+        response = HttpResponse(content_type=content_type)
+        if backend == 'xaccel':
+            response['X-Accel-Redirect'] = settings.SENDFILE_URL_PREFIX.rstrip('/') + '/' + field_file.name
+        else:
+            response['X-Sendfile'] = path
+    else:
+        size = os.path.getsize(path)
+        byte_range = None
+        if_range = request.headers.get('If-Range')
+        if request.method in ('GET', 'HEAD') and (not if_range or if_range == etag):
+            try:
+                byte_range = parse_range(request.headers.get('Range'), size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f'bytes */{size}'
+                return response
+
+        if byte_range:
+            start, end = byte_range
+            length = end - start + 1
+            reader = _aread_range if asynchronous else _read_range
+            response = StreamingHttpResponse(reader(path, start, length), status=206, content_type=content_type)
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response['Content-Length'] = str(length)
+        elif asynchronous:
+            response = StreamingHttpResponse(_aread_range(path, 0, size), content_type=content_type)
+            response['Content-Length'] = str(size)
+        else:
+            response = FileResponse(open(path, 'rb'), content_type=content_type)
+            response.block_size = CHUNK_SIZE
+        response['Accept-Ranges'] = 'bytes'
+
+    response['Content-Disposition'] = content_disposition_header(as_attachment, filename)
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
@@ -10,7 +10,10 @@ from django.db import transaction
 import secrets
 import re
 from datetime import datetime, timedelta
+from django.conf import settings
 from .models import ApiToken, Users, Organizations
+from .uploads import check_pdf_file
+from .utils import normalize_signature_image
 
 class UserForm(forms.ModelForm):
     # Field not in model but needed for validation
@@ -40,11 +43,39 @@ class SignatureForm(forms.ModelForm):
         model = Signature
         fields = ['image']
 
+    def clean_image(self):
+        image = self.cleaned_data.get('image')
+        # Only newly uploaded files; an unchanged instance image is already done
+        if image and hasattr(image, 'content_type'):
+            image = normalize_signature_image(image)
+        return image
+
 class DocumentForm(forms.ModelForm):
     class Meta:
         model = Document
         fields = ['title', 'file']
 
+    def __init__(self, *args, upload_errors=None, max_upload_bytes=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Errors found by PDFUploadHandler while the file was streaming in
+        self.upload_errors = upload_errors or []
+        if max_upload_bytes is None:
+            max_upload_bytes = settings.PDF_UPLOAD_MAX_BYTES
+        self.max_upload_bytes = max_upload_bytes
+        if self.upload_errors:
+            # The file was dropped, so report why instead of "required"
+            self.fields['file'].required = False
+
+    def clean_file(self):
+        if self.upload_errors:
+            raise ValidationError(self.upload_errors)
+        file = self.cleaned_data.get('file')
+        if file:
+            error = check_pdf_file(file, self.max_upload_bytes)
+            if error:
+                raise ValidationError(error)
+        return file
+
 
 class APITokenCreationForm(forms.ModelForm):
     # Form field constants
@@ -719,11 +750,15 @@ class APITokenFilterForm(forms.Form):
         if user:
             queryset = queryset.filter(user=user)
         
+        # Compare against datetime bounds rather than created_at__date so the
+        # created_at indexes can be used instead of casting every row.
         if date_from:
-            queryset = queryset.filter(created_at__date__gte=date_from)
+            start = timezone.make_aware(datetime.combine(date_from, datetime.min.time()))
+            queryset = queryset.filter(created_at__gte=start)
         
         if date_to:
-            queryset = queryset.filter(created_at__date__lte=date_to)
+            end = timezone.make_aware(datetime.combine(date_to + timedelta(days=1), datetime.min.time()))
+            queryset = queryset.filter(created_at__lt=end)
         
         if has_pdf_signing:
             queryset = queryset.filter(allow_pdf_signing=True)
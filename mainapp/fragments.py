@@ -0,0 +1,78 @@
+"""
+Cached page fragments and other results derived from documents.
+
+A fragment is cached under its name and the values it varies on, which
+include a version: the time the relevant documents last changed. The
+signal handlers in mainapp.signals move the version on whenever a Document
+(or a key used to verify one) is saved or deleted, so stale fragments are
+never looked up again and simply expire.
+
+Versions live in the cache too, so with the default local-memory cache a
+change is only seen by the process that made it. Deployments with several
+worker processes should select a shared backend (CACHE_BACKEND).
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.utils.safestring import mark_safe
+
+from . import metrics
+from .routers import track_reads
+
+# Version of everything derived from the documents table as a whole, such
+# as verification results
+ALL_DOCUMENTS = 'all'
+
+
+def _version_key(scope):
+    return f'documents-version:{scope}'
+
+
+def documents_version(scope):
+    """
+    When the documents in ``scope`` (a user id, or ALL_DOCUMENTS) last
+    changed, as far as the cache knows.
+    """
+    key = _version_key(scope)
+    version = cache.get(key)
+    if version is None:
+        # Unknown, e.g. after a restart or eviction: start a new version so
+        # nothing cached under an older one can be served
+        cache.add(key, time.time(), None)
+        version = cache.get(key, time.time())
+    return version
+
+
+def documents_changed(user_id, when=None):
+    """
+    Invalidate fragments built from ``user_id``'s documents, and those built
+    from all documents.
+    """
+    when = time.time() if when is None else when
+    cache.set_many({_version_key(user_id): when, _version_key(ALL_DOCUMENTS): when}, None)
+
+
+def cached(name, vary_on, compute):
+    """
+    Return the value cached for ``name`` and ``vary_on``, or call
+    ``compute()`` for it and cache the result for FRAGMENT_CACHE_TIMEOUT,
+    or only REPLICA_PIN_SECONDS if it was read from a replica.
+    """
+    key = make_template_fragment_key(name, vary_on)
+    value = cache.get(key)
+    metrics.record_cache(name, value is not None)
+    if value is None:
+        with track_reads() as reads:
+            value = compute()
+        cache.set(key, value, reads.cache_timeout(settings.FRAGMENT_CACHE_TIMEOUT))
+    return value
+
+
+def cached_fragment(name, vary_on, render):
+    """
+    cached() for HTML: ``render()`` returns a rendered template fragment,
+    which is returned ready to be inserted into a page.
+    """
+    return mark_safe(cached(name, vary_on, render))
@@ -0,0 +1,69 @@
+import time
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.template import RequestContext
+from django.test import RequestFactory
+
+from mainapp.templating import get_engine, uncached_engine, warm_templates
+
+DEFAULT_TEMPLATES = (
+    'users/home.html',
+    'users/dashboard.html',
+    'users/login.html',
+    'documents/verify.html',
+    'api/apitoken.html',
+    'api/apikey_generate.html',
+)
+
+
+def time_template(engine, name, request, iterations):
+    """
+    Mean seconds to look up ``name`` and render it, as a view does on each
+    request. Templates that can't render without a view's context are only
+    looked up, which includes parsing them but not the templates they extend
+    or include.
+    """
+    template = engine.get_template(name)
+    try:
+        template.render(RequestContext(request))
+    except Exception:
+        render = False
+    else:
+        render = True
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        template = engine.get_template(name)
+        if render:
+            template.render(RequestContext(request))
+    return (time.perf_counter() - start) / iterations, render
+
+
+class Command(BaseCommand):
+    help = 'Compare the per-request cost of templates with and without the cached template loader.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('templates', nargs='*', default=DEFAULT_TEMPLATES)
+        parser.add_argument('--iterations', type=int, default=200)
+
+    def handle(self, *args, **options):
+        iterations = max(options['iterations'], 1)
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        uncached, cached = uncached_engine(), get_engine()
+        warm_templates(cached)
+
+        self.stdout.write(f'{"template":28} {"uncached ms":>12} {"cached ms":>10}')
+        uncached_total = cached_total = 0.0
+        for name in options['templates']:
+            uncached_time, rendered = time_template(uncached, name, request, iterations)
+            cached_time, _ = time_template(cached, name, request, iterations)
+            uncached_total += uncached_time
+            cached_total += cached_time
+            note = '' if rendered else '  (lookup only)'
+            self.stdout.write(f'{name:28} {uncached_time * 1000:12.3f} {cached_time * 1000:10.3f}{note}')
+        self.stdout.write(
+            f'Across these templates: {uncached_total * 1000:.2f} ms uncached, '
+            f'{cached_total * 1000:.2f} ms cached ({uncached_total / cached_total:.1f}x faster).'
+        )
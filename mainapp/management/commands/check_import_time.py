@@ -0,0 +1,104 @@
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mainapp.utils import LAZY_MODULES
+
+_IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)')
+# What every Django project imports on startup, whatever its own code does.
+# The budget is a multiple of this, so it holds on slower machines too.
+REFERENCE_IMPORTS = ('-c', 'import django.core.management, django.db.models')
+
+
+def measure_imports(*args):
+    """
+    Run ``manage.py check`` (or python with ``args``) in a fresh interpreter
+    under ``-X importtime`` and return its {module: (self_us, cumulative_us,
+    depth)}, with depth 0 for modules imported directly rather than by
+    another module.
+    """
+    args = args or (os.path.join(settings.BASE_DIR, 'manage.py'), 'check')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', *args],
+        capture_output=True, text=True, env=os.environ.copy(),
+    )
+    if result.returncode != 0:
+        raise CommandError(f'{" ".join(args)} failed:\n{result.stderr[-2000:]}')
+
+    modules = {}
+    for line in result.stderr.splitlines():
+        match = _IMPORT_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules[name] = (int(self_us), int(cumulative_us), len(indent) // 2)
+    return modules
+
+
+def total_ms(modules):
+    return sum(self_us for self_us, _, _ in modules.values()) / 1000
+
+
+def eager_imports(modules):
+    """
+    The LAZY_MODULES among ``modules``. Signing libraries must only load
+    when a document is signed; Pillow is exempt because Django's ImageField
+    check imports it.
+    """
+    return sorted(name for name in LAZY_MODULES if name in modules and not name.startswith('PIL'))
+
+
+class Command(BaseCommand):
+    help = 'Measure how long starting Django takes to import its modules, against a budget.'
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help='Measurements to take the median of.')
+        parser.add_argument('--top', type=int, default=15, help='Slowest top-level imports to list.')
+        parser.add_argument(
+            '--budget-ratio', type=float, default=3,
+            help='Fail when the median total import time is above this multiple of importing Django alone.',
+        )
+        parser.add_argument(
+            '--budget-ms', type=float,
+            help='Fail when the median total import time is above this many ms, instead of --budget-ratio.',
+        )
+
+    def handle(self, *args, **options):
+        runs = [measure_imports() for _ in range(max(options['runs'], 1))]
+        totals = [total_ms(modules) for modules in runs]
+        median = statistics.median(totals)
+        modules = runs[totals.index(min(totals, key=lambda total: abs(total - median)))]
+
+        self.stdout.write('Slowest top-level imports (cumulative ms):')
+        top_level = sorted(
+            ((cumulative_us, name) for name, (_, cumulative_us, depth) in modules.items() if depth == 0),
+            reverse=True,
+        )
+        for cumulative_us, name in top_level[:options['top']]:
+            self.stdout.write(f'  {cumulative_us / 1000:8.1f}  {name}')
+        self.stdout.write(
+            f'Total import time: median {median:.0f} ms over {len(totals)} runs '
+            f'(min {min(totals):.0f}, max {max(totals):.0f})'
+        )
+
+        eager = eager_imports(modules)
+        if eager:
+            raise CommandError(f'Imported at startup but meant to load lazily: {", ".join(eager)}')
+
+        budget = options['budget_ms']
+        if budget is None:
+            reference = statistics.median(
+                total_ms(measure_imports(*REFERENCE_IMPORTS)) for _ in range(max(options['runs'], 1))
+            )
+            budget = reference * options['budget_ratio']
+            self.stdout.write(
+                f'Budget: {options["budget_ratio"]:g} x {reference:.0f} ms to import Django alone = {budget:.0f} ms'
+            )
+        if median > budget:
+            raise CommandError(f'Startup imports take {median:.0f} ms, over the {budget:.0f} ms budget.')
+        self.stdout.write(self.style.SUCCESS('Within budget.'))
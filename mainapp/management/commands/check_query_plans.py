@@ -0,0 +1,87 @@
+import re
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from mainapp.forms import APITokenFilterForm
+from mainapp.models import ApiToken, Document
+
+
+def hot_queries():
+    """
+    Querysets for the access paths the views hit on every request.
+    Ids are placeholders; only the shape of the plan matters.
+    """
+    now = timezone.now()
+    tokens = ApiToken.objects.all().order_by('-created_at')
+
+    def filtered(**data):
+        form = APITokenFilterForm(data=data)
+        form.is_valid()
+        return form.get_filtered_queryset(tokens)
+
+    return [
+        ('dashboard documents',
+         Document.objects.filter(user_id=1).order_by('-updated_at')),
+        ('verify by hash',
+         Document.objects.filter(hash_value='0' * 64)),
+        ('api token listing',
+         tokens[:25]),
+        ('api tokens active',
+         tokens.filter(expires_at__gt=now)),
+        ('api tokens expiring',
+         tokens.filter(expires_at__gt=now, expires_at__lte=now + timedelta(days=30))),
+        ('api tokens by organization',
+         tokens.filter(organization_id=1)),
+        ('api tokens by date range',
+         filtered(date_from='2026-01-01', date_to='2026-01-31')),
+        ('api tokens with pdf signing',
+         filtered(has_pdf_signing='on')),
+        ('api tokens with form signing',
+         filtered(has_form_signing='on')),
+    ]
+
+
+def is_full_scan(plan, vendor):
+    """
+    Return True if an EXPLAIN output reads a whole table rather than an index.
+    """
+    for line in plan.splitlines():
+        if vendor == 'sqlite':
+            # "SCAN mainapp_document" is a full scan, "SCAN ... USING INDEX" is not.
+            if re.search(r'\bSCAN \w+', line) and ' USING ' not in line:
+                return True
+        elif vendor == 'postgresql':
+            if 'Seq Scan' in line:
+                return True
+    return False
+
+
+class Command(BaseCommand):
+    help = 'EXPLAIN the hot queries and fail if any of them falls back to a full table scan.'
+
+    def handle(self, *args, **options):
+        vendor = connection.vendor
+        if vendor not in ('sqlite', 'postgresql'):
+            raise CommandError(f'Query plan checks are not supported on {vendor}.')
+
+        if vendor == 'postgresql':
+            # Small tables make the planner prefer sequential scans regardless
+            # of indexes; we want to know whether an index path exists at all.
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+
+        failures = []
+        for name, queryset in hot_queries():
+            plan = queryset.explain()
+            if is_full_scan(plan, vendor):
+                failures.append(name)
+                self.stdout.write(self.style.ERROR(f'FULL SCAN  {name}'))
+                self.stdout.write(plan)
+            else:
+                self.stdout.write(self.style.SUCCESS(f'ok         {name}'))
+
+        if failures:
+            raise CommandError(f'{len(failures)} hot queries fall back to a full table scan: {", ".join(failures)}')
@@ -0,0 +1,114 @@
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+
+
+def write_test_pdf(path, pages, image_bytes):
+    """
+    Write a PDF of ``pages`` pages, each with its own incompressible
+    grayscale image of about ``image_bytes`` bytes, like a scanned document.
+    Objects are streamed straight to disk so generating it stays cheap.
+    """
+    width = 256
+    height = max(image_bytes // width, 1)
+    offsets = []
+
+    with open(path, 'wb') as out:
+        def obj(body, stream=None):
+            offsets.append(out.tell())
+            out.write(f'{len(offsets)} 0 obj\n'.encode() + body)
+            if stream is not None:
+                out.write(b'\nstream\n' + stream + b'\nendstream')
+            out.write(b'\nendobj\n')
+
+        out.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        # 1: catalog, 2: page tree, then page, content and image per page
+        obj(b'<< /Type /Catalog /Pages 2 0 R >>')
+        kids = ' '.join(f'{3 + 3 * i} 0 R' for i in range(pages))
+        obj(f'<< /Type /Pages /Count {pages} /Kids [{kids}] >>'.encode())
+        for i in range(pages):
+            page_id = 3 + 3 * i
+            obj(
+                f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {page_id + 1} 0 R '
+                f'/Resources << /XObject << /Scan {page_id + 2} 0 R >> >> >>'.encode()
+            )
+            content = b'q 612 0 0 792 0 0 cm /Scan Do Q'
+            obj(f'<< /Length {len(content)} >>'.encode(), content)
+            pixels = os.urandom(width * height)
+            obj(
+                f'<< /Type /XObject /Subtype /Image /Width {width} /Height {height} '
+                f'/ColorSpace /DeviceGray /BitsPerComponent 8 /Length {len(pixels)} >>'.encode(),
+                pixels,
+            )
+
+        xref_offset = out.tell()
+        out.write(f'xref\n0 {len(offsets) + 1}\n0000000000 65535 f\r\n'.encode())
+        for offset in offsets:
+            out.write(f'{offset:010d} 00000 n\r\n'.encode())
+        out.write(f'trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n'.encode())
+
+
+def _peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _sign_in_child(pdf_path, image_path, output_path, all_pages, results):
+    import django
+    django.setup()
+    from mainapp.utils import sign_pdf
+
+    baseline = _peak_rss_kb()
+    start = time.perf_counter()
+    sign_pdf(pdf_path, image_path, output_path, all_pages=all_pages)
+    results.put((baseline, _peak_rss_kb(), time.perf_counter() - start))
+
+
+class Command(BaseCommand):
+    help = 'Sign a generated many-page scanned-style PDF and check the peak memory it takes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=5000)
+        parser.add_argument('--image-kb', type=int, default=32, help='Size of the image on each page.')
+        parser.add_argument('--last-page', action='store_true', help='Stamp only the last page, not every page.')
+        parser.add_argument(
+            '--max-rss-mb', type=float, default=64,
+            help='Fail when signing raises peak RSS by more than this.',
+        )
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as tmp:
+            pdf_path = os.path.join(tmp, 'large.pdf')
+            image_path = os.path.join(tmp, 'signature.png')
+            output_path = os.path.join(tmp, 'signed.pdf')
+
+            write_test_pdf(pdf_path, options['pages'], options['image_kb'] * 1024)
+            Image.new('L', (300, 100), 0).save(image_path)
+            size_mb = os.path.getsize(pdf_path) / 2**20
+
+            # A fresh interpreter, so the peak belongs to the signing alone
+            context = multiprocessing.get_context('spawn')
+            results = context.Queue()
+            child = context.Process(
+                target=_sign_in_child,
+                args=(pdf_path, image_path, output_path, not options['last_page'], results),
+            )
+            child.start()
+            child.join()
+            if child.exitcode != 0:
+                raise CommandError(f'Signing failed (exit code {child.exitcode}).')
+            baseline, peak, elapsed = results.get()
+
+        growth_mb = (peak - baseline) / 1024
+        self.stdout.write(
+            f'{options["pages"]} pages, {size_mb:.0f} MB: signed in {elapsed:.2f}s, '
+            f'peak RSS {peak / 1024:.0f} MB ({growth_mb:.0f} MB above the {baseline / 1024:.0f} MB baseline)'
+        )
+        if growth_mb > options['max_rss_mb']:
+            raise CommandError(f'Signing took {growth_mb:.0f} MB, over the {options["max_rss_mb"]:.0f} MB budget.')
+        self.stdout.write(self.style.SUCCESS('Within budget.'))
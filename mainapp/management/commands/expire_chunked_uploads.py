@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from mainapp import chunked
+
+
+class Command(BaseCommand):
+    help = 'Remove resumable uploads that expired before they were completed, and their staging files.'
+
+    def handle(self, *args, **options):
+        uploads, orphans = chunked.expire_uploads()
+        self.stdout.write(self.style.SUCCESS(
+            f'Removed {uploads} expired uploads and {orphans} staging files without an upload.'
+        ))
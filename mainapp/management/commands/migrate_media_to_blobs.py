@@ -0,0 +1,56 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from mainapp.models import Document, Signature
+from mainapp.storage import BLOB_PREFIX, ContentAddressedStorage
+
+FIELDS = [
+    (Document, 'file'),
+    (Document, 'signed_file'),
+    (Signature, 'image'),
+]
+
+
+class Command(BaseCommand):
+    help = 'Move media saved before content-addressed storage into deduplicated blobs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be migrated without changing anything.')
+        parser.add_argument('--delete-originals', action='store_true', help='Remove the old files once every row referencing them is migrated.')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, dry_run=False, delete_originals=False, batch_size=500, **options):
+        if not isinstance(default_storage, ContentAddressedStorage):
+            raise CommandError('The default storage is not ContentAddressedStorage; check STORAGES.')
+
+        migrated = missing = 0
+        old_names = set()
+        for model, field in FIELDS:
+            legacy = model.objects.exclude(**{f'{field}__startswith': BLOB_PREFIX}).exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+            for pk, name in legacy.values_list('pk', field).iterator(chunk_size=batch_size):
+                if not default_storage.exists(name):
+                    missing += 1
+                    self.stderr.write(f'Missing file for {model.__name__} {pk} {field}: {name}')
+                    continue
+                if dry_run:
+                    self.stdout.write(f'Would migrate {model.__name__} {pk} {field}: {name}')
+                    migrated += 1
+                    continue
+
+                # Streams the old file through the hashing storage in chunks
+                with default_storage.open(name, 'rb') as content:
+                    new_name = default_storage.save(name, content)
+                # update() rather than save() so updated_at is left alone
+                model.objects.filter(pk=pk).update(**{field: new_name})
+                old_names.add(name)
+                migrated += 1
+
+        if delete_originals and not dry_run:
+            for name in sorted(old_names):
+                still_used = any(model.objects.filter(**{field: name}).exists() for model, field in FIELDS)
+                if not still_used:
+                    default_storage.delete(name)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{"Would migrate" if dry_run else "Migrated"} {migrated} files ({missing} missing).'
+        ))
@@ -0,0 +1,34 @@
+import os
+
+from django.core.files import File
+from django.core.management.base import BaseCommand
+
+from mainapp.models import Signature
+from mainapp.utils import normalize_signature_image
+
+
+class Command(BaseCommand):
+    help = 'Normalize signature images uploaded before upload-time optimization.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report sizes without changing anything.')
+
+    def handle(self, *args, dry_run=False, **options):
+        saved = 0
+        for signature in Signature.objects.exclude(image='').exclude(image__isnull=True).iterator():
+            if not signature.image.storage.exists(signature.image.name):
+                self.stderr.write(f'Missing image for signature {signature.pk}: {signature.image.name}')
+                continue
+            with signature.image.open('rb') as f:
+                optimized = normalize_signature_image(File(f, name=os.path.basename(signature.image.name)))
+            before, after = signature.image.size, optimized.size
+            if after >= before:
+                continue
+            self.stdout.write(f'Signature {signature.pk}: {before} -> {after} bytes')
+            saved += before - after
+            if not dry_run:
+                old = signature.image.name
+                signature.image.save(optimized.name, optimized, save=False)
+                Signature.objects.filter(pk=signature.pk).update(image=signature.image.name)
+                signature.image.storage.delete(old)
+        self.stdout.write(self.style.SUCCESS(f'{"Would save" if dry_run else "Saved"} {saved} bytes.'))
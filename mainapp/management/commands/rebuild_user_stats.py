@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from mainapp import fragments, stats
+from mainapp.models import Users
+
+
+class Command(BaseCommand):
+    help = 'Recount the per-user document statistics the dashboard shows.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*', help='Users to recount; all users by default.')
+
+    def handle(self, *args, **options):
+        users = Users.objects.order_by('pk')
+        if options['usernames']:
+            users = users.filter(username__in=options['usernames'])
+        rebuilt = 0
+        for user_id in users.values_list('pk', flat=True).iterator():
+            stats.rebuild(user_id)
+            # Drop dashboards cached with the old totals
+            fragments.documents_changed(user_id)
+            rebuilt += 1
+        self.stdout.write(self.style.SUCCESS(f'Recounted statistics for {rebuilt} users.'))
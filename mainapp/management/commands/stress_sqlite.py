@@ -0,0 +1,136 @@
+import multiprocessing
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+ALIAS = 'stress'
+
+
+def _connect(path, options):
+    """
+    Register a connection to the scratch database at ``path`` under ALIAS.
+    """
+    from django.db import connections
+
+    connections.settings[ALIAS] = connections.configure_settings({
+        'default': connections.settings['default'],
+        ALIAS: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': path, 'OPTIONS': options},
+    })[ALIAS]
+    return connections[ALIAS]
+
+
+def _writer(path, options, transactions, hold, results):
+    import django
+    django.setup()
+    from django.db import OperationalError, transaction
+
+    connection = _connect(path, options)
+    committed = locked = 0
+    latencies = []
+    for _ in range(transactions):
+        start = time.perf_counter()
+        try:
+            # Read, then write, as signing does: the pattern that fails
+            # outright when a deferred transaction can't upgrade its lock
+            with transaction.atomic(using=ALIAS), connection.cursor() as cursor:
+                cursor.execute('SELECT value FROM counter WHERE id = 1')
+                cursor.fetchone()
+                time.sleep(hold)
+                cursor.execute('UPDATE counter SET value = value + 1 WHERE id = 1')
+                cursor.execute('INSERT INTO log (written_at) VALUES (%s)', [time.time()])
+        except OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            locked += 1
+        else:
+            committed += 1
+            latencies.append(time.perf_counter() - start)
+    connection.close()
+    results.put((committed, locked, latencies))
+
+
+def run(path, options, writers, transactions, hold):
+    """
+    Run ``writers`` processes of ``transactions`` write transactions each
+    against a fresh database at ``path``. Returns (committed, locked,
+    latencies, final counter value, elapsed seconds).
+    """
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    connection = _connect(path, options)
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE TABLE counter (id INTEGER PRIMARY KEY, value INTEGER NOT NULL)')
+        cursor.execute('CREATE TABLE log (id INTEGER PRIMARY KEY, written_at REAL NOT NULL)')
+        cursor.execute('INSERT INTO counter (id, value) VALUES (1, 0)')
+    connection.close()
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    processes = [
+        context.Process(target=_writer, args=(path, options, transactions, hold, results))
+        for _ in range(writers)
+    ]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+    if any(process.exitcode != 0 for process in processes):
+        raise CommandError('A writer process failed.')
+
+    connection = _connect(path, options)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT value FROM counter WHERE id = 1')
+        value = cursor.fetchone()[0]
+    connection.close()
+
+    committed = sum(outcome[0] for outcome in outcomes)
+    locked = sum(outcome[1] for outcome in outcomes)
+    latencies = sorted(latency for outcome in outcomes for latency in outcome[2])
+    return committed, locked, latencies, value, elapsed
+
+
+class Command(BaseCommand):
+    help = (
+        'Run concurrent SQLite writers against a scratch database, with Django\'s default '
+        'connection options and with SQLITE_OPTIONS, and check the tuned run has no lock errors.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8)
+        parser.add_argument('--transactions', type=int, default=50, help='Transactions per writer.')
+        parser.add_argument(
+            '--hold-ms', type=float, default=2,
+            help='Time each transaction spends between its read and its write.',
+        )
+
+    def handle(self, *args, **options):
+        hold = options['hold_ms'] / 1000
+        expected = options['writers'] * options['transactions']
+        failed = False
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'stress.sqlite3')
+            for label, db_options in (('default', {}), ('tuned', settings.SQLITE_OPTIONS)):
+                committed, locked, latencies, value, elapsed = run(
+                    path, db_options, options['writers'], options['transactions'], hold,
+                )
+                p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+                p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+                self.stdout.write(
+                    f'{label:8} {committed}/{expected} committed, {locked} "database is locked", '
+                    f'{committed / elapsed:.0f} tx/s, p50 {p50:.1f} ms, p99 {p99:.1f} ms'
+                )
+                if value != committed:
+                    raise CommandError(f'{label}: counter is {value} after {committed} commits.')
+                if label == 'tuned':
+                    failed = locked > 0
+
+        if failed:
+            raise CommandError('Writers still failed with the tuned options.')
+        self.stdout.write(self.style.SUCCESS('No lock errors with the tuned options.'))
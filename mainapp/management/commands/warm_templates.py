@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from mainapp.templating import warm_templates
+
+
+class Command(BaseCommand):
+    help = 'Compile every template into the cached template loader.'
+
+    def handle(self, *args, **options):
+        compiled, errors = warm_templates()
+        for name, error in errors.items():
+            self.stderr.write(self.style.WARNING(f'{name}: {error}'))
+        self.stdout.write(self.style.SUCCESS(f'Compiled {len(compiled)} templates.'))
@@ -0,0 +1,104 @@
+"""
+Prometheus metrics for signing, verification and key operations.
+
+Stage durations come from the mainapp.timing hook API. When the
+PROMETHEUS_MULTIPROC_DIR environment variable is set (before the workers
+start), prometheus_client keeps each worker's values in memory-mapped
+files in that directory, and ``render`` merges them at scrape time.
+"""
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest,
+)
+from prometheus_client import multiprocess
+
+from . import timing
+
+BUCKETS = timing.DEFAULT_BUCKETS
+
+STAGE_DURATION = Histogram(
+    'digisigner_stage_duration_seconds',
+    'Time spent in each signing, verification and key operation stage.',
+    ['stage'],
+    buckets=BUCKETS,
+)
+SIGNINGS = Counter(
+    'digisigner_signings_total',
+    'Documents signed, by whether a visual signature and a cryptographic signature were added.',
+    ['visual', 'cryptographic'],
+)
+SIGNING_ERRORS = Counter(
+    'digisigner_signing_errors_total',
+    'Signing attempts that failed.',
+)
+VERIFICATIONS = Counter(
+    'digisigner_verifications_total',
+    'Verification requests, by outcome.',
+    ['result'],
+)
+KEYS_GENERATED = Counter(
+    'digisigner_keys_generated_total',
+    'Key pairs generated.',
+)
+UPLOAD_BYTES = Counter(
+    'digisigner_upload_bytes_total',
+    'Bytes received in uploads, by kind of upload.',
+    ['kind'],
+)
+CACHE_REQUESTS = Counter(
+    'digisigner_cache_requests_total',
+    'Cache lookups, by cache and hit or miss.',
+    ['cache', 'result'],
+)
+DB_QUERIES = Counter(
+    'digisigner_db_queries_total',
+    'SQL queries executed while serving requests.',
+)
+DB_DURATION = Histogram(
+    'digisigner_request_db_seconds',
+    'Total SQL time per request.',
+    buckets=BUCKETS,
+)
+CPU_QUEUE_DEPTH = Gauge(
+    'digisigner_cpu_queue_depth',
+    'CPU-bound tasks waiting for a CPU pool thread.',
+    multiprocess_mode='livesum',
+)
+CPU_QUEUE_WAIT = Histogram(
+    'digisigner_cpu_queue_wait_seconds',
+    'Time CPU-bound tasks waited for a CPU pool thread.',
+    buckets=BUCKETS,
+)
+CPU_REJECTIONS = Counter(
+    'digisigner_cpu_rejections_total',
+    'CPU-bound tasks turned away because the CPU pool queue was full.',
+)
+
+
+def _observe_stage(name, seconds):
+    STAGE_DURATION.labels(stage=name).observe(seconds)
+
+
+timing.register_hook(_observe_stage)
+
+
+def record_cache(cache, hit):
+    CACHE_REQUESTS.labels(cache=cache, result='hit' if hit else 'miss').inc()
+
+
+def record_db(query_count, seconds):
+    DB_QUERIES.inc(query_count)
+    DB_DURATION.observe(seconds)
+
+
+def render():
+    """
+    Return the exposition body and content type for a scrape.
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
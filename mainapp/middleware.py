@@ -0,0 +1,239 @@
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+from django.utils.deprecation import MiddlewareMixin
+
+from . import metrics
+from .offload import Overloaded
+from .routers import PIN_COOKIE, routing_request
+
+logger = logging.getLogger('mainapp.sql')
+
+# Collapse literal values and IN (...) lists so the same query issued with
+# different arguments maps to one shape.
+_IN_LIST = re.compile(r'\bIN \((?:%s|\?)(?:, (?:%s|\?))*\)')
+_NUMBER = re.compile(r'\b\d+\b')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+
+
+def query_shape(sql):
+    """
+    Normalise a SQL statement so repeated queries differing only in their
+    parameters compare equal.
+    """
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    return _IN_LIST.sub('IN (...)', sql)
+
+
+class QueryRecorder:
+    """
+    Counts queries and accumulates SQL time. Use it as an execute_wrapper
+    directly, or activate it for a whole context with recording_queries().
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+        self.aliases = Counter()
+
+    def record(self, sql, duration, alias=None):
+        self.duration += duration
+        self.count += 1
+        self.shapes[query_shape(sql)] += 1
+        self.aliases[alias] += 1
+
+    def count_for(self, alias):
+        return self.aliases[alias]
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.record(sql, time.perf_counter() - start, context['connection'].alias)
+
+    def duplicates(self, threshold):
+        return {shape: n for shape, n in self.shapes.items() if n >= threshold}
+
+
+# Recorders active in the current context. Context variables follow work
+# handed to other threads with sync_to_async, so queries an async view runs
+# in a thread pool are still counted against its request.
+_active_recorders = ContextVar('active_query_recorders', default=())
+
+
+def _dispatch_query(execute, sql, params, many, context):
+    recorders = _active_recorders.get()
+    if not recorders:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - start
+        for recorder in recorders:
+            recorder.record(sql, duration, context['connection'].alias)
+
+
+def _install_dispatch(connection):
+    if _dispatch_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_dispatch_query)
+
+
+def _on_connection_created(sender, connection, **kwargs):
+    _install_dispatch(connection)
+
+
+connection_created.connect(_on_connection_created)
+
+
+@contextmanager
+def recording_queries(recorder=None):
+    """
+    Send every query run in this context, on whichever thread, to
+    ``recorder`` (a new QueryRecorder unless given) as well as to any
+    recorders already active.
+    """
+    recorder = recorder if recorder is not None else QueryRecorder()
+    # Connections opened before this module was imported
+    for conn in connections.all():
+        _install_dispatch(conn)
+    token = _active_recorders.set(_active_recorders.get() + (recorder,))
+    try:
+        yield recorder
+    finally:
+        _active_recorders.reset(token)
+
+
+class QueryInstrumentationMiddleware:
+    """
+    Record the number of queries and the total SQL time of each request.
+
+    The totals are sent back in a Server-Timing header and logged to
+    ``mainapp.sql``; query shapes repeated SQL_DUPLICATE_QUERY_THRESHOLD
+    times or more are logged as likely N+1 patterns.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, 'SQL_INSTRUMENTATION_ENABLED', True)
+        self.duplicate_threshold = getattr(settings, 'SQL_DUPLICATE_QUERY_THRESHOLD', 3)
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.enabled:
+            return self.get_response(request)
+
+        with recording_queries() as recorder:
+            response = self.get_response(request)
+        return self.report(request, response, recorder)
+
+    async def __acall__(self, request):
+        if not self.enabled:
+            return await self.get_response(request)
+
+        with recording_queries() as recorder:
+            response = await self.get_response(request)
+        return self.report(request, response, recorder)
+
+    def report(self, request, response, recorder):
+        request.sql_queries = recorder
+        metrics.record_db(recorder.count, recorder.duration)
+        duration_ms = recorder.duration * 1000
+        timing = f'db;dur={duration_ms:.1f};desc="{recorder.count} queries"'
+        if response.has_header('Server-Timing'):
+            timing = f"{response['Server-Timing']}, {timing}"
+        response['Server-Timing'] = timing
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else None
+        logger.info(
+            'sql view=%s path=%s status=%s queries=%d duration_ms=%.1f',
+            view, request.path, response.status_code, recorder.count, duration_ms,
+            extra={
+                'view': view,
+                'path': request.path,
+                'status': response.status_code,
+                'query_count': recorder.count,
+                'sql_duration_ms': round(duration_ms, 1),
+            },
+        )
+        for shape, n in recorder.duplicates(self.duplicate_threshold).items():
+            logger.warning(
+                'duplicate query view=%s count=%d sql=%s', view, n, shape,
+                extra={'view': view, 'path': request.path, 'query_count': n, 'sql': shape},
+            )
+        return response
+
+
+class OverloadMiddleware(MiddlewareMixin):
+    """
+    Answer requests whose CPU-bound work was turned away by a full CPU pool
+    with 503 Service Unavailable and a Retry-After header.
+    """
+
+    def process_exception(self, request, exception):
+        if not isinstance(exception, Overloaded):
+            return None
+        logger.warning('cpu pool full path=%s', request.path, extra={'path': request.path})
+        response = HttpResponse(str(exception), status=503, content_type='text/plain')
+        response['Retry-After'] = str(exception.retry_after)
+        return response
+
+
+class ReplicaPinMiddleware:
+    """
+    Track each request's database routing (see mainapp.routers) and, after
+    a request that wrote to the primary, set a cookie that keeps the
+    client's reads on the primary for REPLICA_PIN_SECONDS.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        with routing_request(request) as state:
+            response = self.get_response(request)
+        return self.pin(response, state)
+
+    async def __acall__(self, request):
+        with routing_request(request) as state:
+            response = await self.get_response(request)
+        return self.pin(response, state)
+
+    def pin(self, response, state):
+        if state.wrote:
+            response.set_cookie(
+                PIN_COOKIE, '1',
+                max_age=settings.REPLICA_PIN_SECONDS,
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite='Lax',
+            )
+        return response
@@ -0,0 +1,41 @@
+# Generated by Django 6.0.1 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0005_organizations_apitoken'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='apitoken',
+            index=models.Index(fields=['-created_at'], name='apitoken_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='apitoken',
+            index=models.Index(fields=['organization', '-created_at'], name='apitoken_org_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='apitoken',
+            index=models.Index(fields=['expires_at'], name='apitoken_expires_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='apitoken',
+            index=models.Index(condition=models.Q(('allow_pdf_signing', True)), fields=['-created_at'], name='apitoken_pdf_signing_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='apitoken',
+            index=models.Index(condition=models.Q(('allow_form_signing', True)), fields=['-created_at'], name='apitoken_form_signing_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['user', '-updated_at'], name='document_user_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['hash_value'], name='document_hash_idx'),
+        ),
+    ]
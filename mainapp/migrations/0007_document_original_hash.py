@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-19 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0006_document_apitoken_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='original_hash',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 6.0.1 on 2026-10-19 13:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0008_storedblob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apitoken',
+            name='max_upload_bytes',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='users',
+            name='max_upload_bytes',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -1,3 +1,5 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 
@@ -17,6 +19,7 @@ class Users(TimeStampedModel, AbstractUser):
     contact= models.IntegerField(unique=True)
     password = models.CharField(max_length=128)
     confirm_password = models.CharField(max_length=128)
+    max_upload_bytes = models.PositiveBigIntegerField(null=True, blank=True) # Overrides PDF_UPLOAD_MAX_BYTES
     
     
     def __str__(self):
@@ -40,11 +43,38 @@ class Document(TimeStampedModel):
     file = models.FileField(upload_to='documents/original/', null=False, blank=False)
     signed_file = models.FileField(upload_to='documents/signed/', null=True, blank=True)
     hash_value = models.CharField(max_length=64, blank=True, null=True)
+    original_hash = models.CharField(max_length=64, blank=True, null=True) # SHA256 of the upload
     signature_data = models.TextField(blank=True, null=True) # Cryptographic signature
 
+    class Meta:
+        indexes = [
+            # dashboard: filter(user=...).order_by('-updated_at')
+            models.Index(fields=['user', '-updated_at'], name='document_user_updated_idx'),
+            # verify_document: get(hash_value=...)
+            models.Index(fields=['hash_value'], name='document_hash_idx'),
+        ]
+
     def __str__(self):
         return self.title
 
+class UserStats(TimeStampedModel):
+    """
+    Running totals of a user's documents, kept up to date by the Document
+    signal handlers in mainapp.stats.
+    """
+    user = models.OneToOneField(Users, on_delete=models.CASCADE, related_name='stats')
+    documents = models.PositiveIntegerField(default=0)
+    signed = models.PositiveIntegerField(default=0) # With a signed_file
+    crypto_signed = models.PositiveIntegerField(default=0) # With signature_data
+    bytes_stored = models.PositiveBigIntegerField(default=0) # Original and signed files
+
+    @property
+    def pending(self):
+        return self.documents - self.signed
+
+    def __str__(self):
+        return f"Stats for user {self.user_id}"
+
 class UserKey(TimeStampedModel):
     user = models.OneToOneField(Users, on_delete=models.CASCADE, related_name='key_pair')
     public_key = models.TextField()
@@ -65,11 +95,59 @@ class ApiToken(TimeStampedModel):
     allow_pdf_verification = models.BooleanField(default=False)
     allow_form_signing = models.BooleanField(default=False)
     allow_form_verification = models.BooleanField(default=False)
+    max_upload_bytes = models.PositiveBigIntegerField(null=True, blank=True) # Overrides the user's limit
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # api_tokens_view listing and the created_at date range filters
+            models.Index(fields=['-created_at'], name='apitoken_created_idx'),
+            models.Index(fields=['organization', '-created_at'], name='apitoken_org_created_idx'),
+            # active / expiring / expired status filters and counts
+            models.Index(fields=['expires_at'], name='apitoken_expires_idx'),
+            # permission filters only ever ask for True, so keep the indexes partial
+            models.Index(
+                fields=['-created_at'],
+                name='apitoken_pdf_signing_idx',
+                condition=models.Q(allow_pdf_signing=True),
+            ),
+            models.Index(
+                fields=['-created_at'],
+                name='apitoken_form_signing_idx',
+                condition=models.Q(allow_form_signing=True),
+            ),
+        ]
     
     def __str__(self):
         return self.token
 
 
-    
+class StoredBlob(TimeStampedModel):
+    """
+    A file kept by ContentAddressedStorage and how many fields reference it.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    sha256 = models.CharField(max_length=64, db_index=True)
+    size = models.BigIntegerField()
+    refcount = models.PositiveIntegerField(default=1)
+
+    def __str__(self):
+        return self.name
+
+
+class ChunkedUpload(TimeStampedModel):
+    """
+    A resumable upload in progress; see mainapp.chunked.
+    """
+    upload_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    user = models.ForeignKey(Users, on_delete=models.CASCADE)
+    title = models.CharField(max_length=255)
+    filename = models.CharField(max_length=255)
+    length = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    part_hashes = models.JSONField(default=list, blank=True) # SHA256 of each received part
+    document = models.ForeignKey(Document, on_delete=models.SET_NULL, null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.length})"
@@ -0,0 +1,158 @@
+"""
+Running blocking work from async views.
+
+Under ASGI an async view holds no thread while a slow client sends its
+upload or reads its download, so one process can serve thousands of them.
+Anything that blocks - ORM queries, parsing request bodies, hashing, PDF
+and crypto work, template rendering - goes through run_blocking(), which
+runs it on a dedicated pool of BLOCKING_WORKERS threads. Heavy requests
+therefore can't starve the event loop, Django's own thread-sensitive
+executor, or each other beyond that bound.
+
+CPU-heavy work - stamping PDFs, RSA signing and verification - goes
+through run_cpu() instead, onto a much smaller pool. That work is pure
+Python (pypdf, reportlab) or holds the GIL, so threads don't run it in
+parallel: the cores are used by running one server process per core, and
+the pool is about admission instead. It runs as many tasks at a time as
+the process can actually make progress on - one by default - rather than
+interleaving a burst of them so that all finish late, and its queue is
+bounded: once CPU_QUEUE_SIZE tasks are waiting, run_cpu() raises
+Overloaded, which OverloadMiddleware turns into a 503 with Retry-After, so
+a burst is shed rather than making every request slow.
+
+Both pools run their tasks in the caller's context, so timing stages and
+query recorders see them, and under timing.sampled_thread(), so slow
+requests' profiles sample the thread doing the work.
+"""
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import metrics, timing
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def reset():
+    """
+    Forget the pools without shutting them down, e.g. in a forked child,
+    where their threads don't exist. They're recreated on next use.
+    """
+    global _executor, _cpu_pool, _executor_lock
+    _executor = None
+    _cpu_pool = None
+    _executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.BLOCKING_WORKERS,
+                    thread_name_prefix='mainapp-blocking',
+                )
+    return _executor
+
+
+def _call(func, args, kwargs):
+    try:
+        with timing.sampled_thread():
+            return func(*args, **kwargs)
+    finally:
+        # Pool threads outlive requests, so apply CONN_MAX_AGE here the way
+        # request_finished does for request threads
+        close_old_connections()
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Await ``func(*args, **kwargs)`` run on the blocking-work pool. Context
+    variables (the request's timing stages and query recorders) carry over.
+    """
+    return await sync_to_async(_call, thread_sensitive=False, executor=get_executor())(func, args, kwargs)
+
+
+async def resolve_user(request):
+    """
+    Replace the lazy ``request.user`` with the user request.auser() loads
+    (and caches), so code on the blocking pool doesn't query for it again.
+    """
+    if hasattr(request, 'auser'):
+        request.user = await request.auser()
+
+
+class Overloaded(Exception):
+    """
+    The CPU pool's queue is full; the client should retry after
+    ``retry_after`` seconds.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__('The server is busy, please try again shortly.')
+        self.retry_after = retry_after
+
+
+class CPUPool:
+    """
+    A thread pool for CPU-bound work that admits at most ``workers`` running
+    plus ``queue_size`` waiting tasks, rejecting the rest with Overloaded.
+    """
+
+    def __init__(self, workers, queue_size, retry_after):
+        self.workers = workers
+        self.retry_after = retry_after
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mainapp-cpu')
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def submit(self, func, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            metrics.CPU_REJECTIONS.inc()
+            raise Overloaded(self.retry_after)
+        queued_at = time.perf_counter()
+        metrics.CPU_QUEUE_DEPTH.inc()
+
+        def task():
+            metrics.CPU_QUEUE_DEPTH.dec()
+            metrics.CPU_QUEUE_WAIT.observe(time.perf_counter() - queued_at)
+            with timing.sampled_thread():
+                return func(*args, **kwargs)
+
+        try:
+            # In the caller's context, so its timing stages are recorded
+            future = self._executor.submit(contextvars.copy_context().run, task)
+        except BaseException:
+            metrics.CPU_QUEUE_DEPTH.dec()
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+
+_cpu_pool = None
+
+
+def get_cpu_pool():
+    global _cpu_pool
+    if _cpu_pool is None:
+        with _executor_lock:
+            if _cpu_pool is None:
+                _cpu_pool = CPUPool(
+                    max(settings.CPU_WORKERS, 1), settings.CPU_QUEUE_SIZE, settings.CPU_RETRY_AFTER,
+                )
+    return _cpu_pool
+
+
+def run_cpu(func, *args, **kwargs):
+    """
+    Run ``func(*args, **kwargs)`` on the CPU pool and wait for its result.
+    Raises Overloaded if the pool's queue is full.
+    """
+    return get_cpu_pool().submit(func, *args, **kwargs).result()
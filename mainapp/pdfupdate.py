@@ -0,0 +1,260 @@
+"""
+Editing PDFs by incremental update.
+
+Rather than parsing a document and writing every object back out, an
+IncrementalUpdate copies the original file byte for byte (in the kernel,
+via shutil.copyfile) and appends only the objects that were added or
+changed, followed by a cross-reference section that points back at the
+original one (ISO 32000-1, 7.5.6). Only the objects actually looked at are
+parsed, so memory use depends on what is modified, not on the size of the
+file. As a bonus, earlier digital signatures in the document stay valid.
+
+The source is read with ordinary buffered reads rather than a memory map:
+pypdf touches every object header while loading the cross-reference table,
+and with a map the kernel's fault-around pulls the whole file into the
+process's resident set.
+"""
+import copy
+import io
+import os
+import re
+import shutil
+import struct
+import zlib
+
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import (
+    ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject,
+)
+
+_STARTXREF = re.compile(rb'startxref\s+(\d+)')
+_OBJECT_HEADER = re.compile(rb'\s*\d+\s+\d+\s+obj')
+TAIL_WINDOW = 1024
+
+
+class DamagedPDFError(ValueError):
+    """
+    The document's cross-reference data can't be appended to; it has to be
+    rewritten with repair() first.
+    """
+
+
+def repair(source_path, output_path):
+    """
+    Rewrite a PDF with damaged cross-reference data as a clean file. This
+    loads the whole document, so it is only for files that need it.
+    """
+    with open(source_path, 'rb') as f:
+        writer = PdfWriter(clone_from=PdfReader(f))
+        with open(output_path, 'wb') as out:
+            writer.write(out)
+
+
+class IncrementalUpdate:
+    """
+    An append-only edit of the PDF at ``path``.
+
+    Change objects read through ``reader`` (e.g. ``pages``) in place and
+    report them with modified(); add new ones with add_object(), or copy
+    them in from another document with import_object(). write() produces
+    the updated file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._file.seek(0, os.SEEK_END)
+            size = self._file.tell()
+            self._file.seek(max(size - TAIL_WINDOW, 0))
+            found = _STARTXREF.findall(self._file.read(TAIL_WINDOW))
+            self.prev_xref = int(found[-1]) if found else -1
+            head = b''
+            if 0 <= self.prev_xref < size:
+                self._file.seek(self.prev_xref)
+                head = self._file.read(32)
+            if head.startswith(b'xref'):
+                self.xref_stream = False
+            elif _OBJECT_HEADER.match(head):
+                self.xref_stream = True
+            else:
+                raise DamagedPDFError('PDF cross-reference data is damaged.')
+
+            self.reader = PdfReader(self._file)
+            if self.reader.is_encrypted:
+                raise ValueError('Encrypted PDF documents are not supported.')
+        except Exception:
+            self.close()
+            raise
+
+        highest = max(
+            [int(self.reader.trailer.get('/Size', 0)) - 1, *self.reader.xref_objStm]
+            + [idnum for entries in self.reader.xref.values() for idnum in entries]
+        )
+        self._next_idnum = highest + 1
+        self._objects = {}  # idnum -> (generation, object) to write
+        self._imported = {}  # (id(source), idnum, generation) -> IndirectObject
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.reader = None
+        self._file.close()
+
+    @property
+    def pages(self):
+        return self.reader.pages
+
+    def add_object(self, obj):
+        """
+        Add a new object to the document and return a reference to it.
+        """
+        idnum = self._next_idnum
+        self._next_idnum += 1
+        self._objects[idnum] = (0, obj)
+        return IndirectObject(idnum, 0, self)
+
+    def modified(self, obj):
+        """
+        Mark an object read from the document as changed. Direct objects are
+        written as part of their parent, which must be marked instead.
+        """
+        ref = getattr(obj, 'indirect_reference', None)
+        if ref is None:
+            return False
+        self._objects[ref.idnum] = (ref.generation, obj)
+        return True
+
+    def is_array(self, obj):
+        """
+        Whether ``obj`` is, or refers to, an array. For references this peeks
+        at the object's first token so that a content stream isn't loaded
+        just to learn it is not one.
+        """
+        if not isinstance(obj, IndirectObject):
+            return isinstance(obj, ArrayObject)
+        if obj.idnum in self.reader.xref_objStm:
+            # Streams can't be stored in object streams, so this is cheap
+            return isinstance(obj.get_object(), ArrayObject)
+        offset = self.reader.xref.get(obj.generation, {}).get(obj.idnum)
+        if offset is None:
+            return isinstance(obj.get_object(), ArrayObject)
+        self._file.seek(offset)
+        head = self._file.read(64)
+        match = _OBJECT_HEADER.match(head)
+        return bool(match) and head[match.end():].lstrip().startswith(b'[')
+
+    def import_object(self, obj):
+        """
+        Copy an object from another document, along with everything it
+        references, and return the copy (a reference for indirect objects).
+        """
+        if isinstance(obj, IndirectObject):
+            key = (id(obj.pdf), obj.idnum, obj.generation)
+            if key not in self._imported:
+                # Reserve the number first: references can be circular
+                ref = self._imported[key] = self.add_object(None)
+                self._objects[ref.idnum] = (0, self.import_object(obj.get_object()))
+            return self._imported[key]
+        if isinstance(obj, DictionaryObject):
+            # copy() keeps a stream's encoded data as-is
+            dup = copy.copy(obj)
+            for key, value in dict.items(obj):
+                dup[key] = self.import_object(value)
+            return dup
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self.import_object(value) for value in obj)
+        return obj
+
+    def write(self, output_path):
+        """
+        Write the original document plus the update to ``output_path``,
+        which may be the source file itself.
+        """
+        if os.path.abspath(output_path) != os.path.abspath(self.path):
+            shutil.copyfile(self.path, output_path)
+        if not self._objects:
+            return output_path
+
+        with open(output_path, 'r+b') as out:
+            out.seek(0, os.SEEK_END)
+            out.write(b'\n')
+            offsets = {}
+            for idnum, (generation, obj) in sorted(self._objects.items()):
+                offsets[idnum] = (out.tell(), generation)
+                out.write(f'{idnum} {generation} obj\n'.encode())
+                obj.write_to_stream(out)
+                out.write(b'\nendobj\n')
+
+            trailer = DictionaryObject({NameObject('/Prev'): NumberObject(self.prev_xref)})
+            for key in ('/Root', '/Info', '/ID'):
+                if key in self.reader.trailer:
+                    trailer[NameObject(key)] = self.reader.trailer.raw_get(key)
+
+            if self.xref_stream:
+                self._write_xref_stream(out, offsets, trailer)
+            else:
+                self._write_xref_table(out, offsets, trailer)
+        return output_path
+
+    @staticmethod
+    def _subsections(idnums):
+        """
+        Split sorted object numbers into runs of consecutive numbers.
+        """
+        runs = []
+        for idnum in idnums:
+            if runs and runs[-1][-1] + 1 == idnum:
+                runs[-1].append(idnum)
+            else:
+                runs.append([idnum])
+        return runs
+
+    def _write_xref_table(self, out, offsets, trailer):
+        xref_offset = out.tell()
+        # Starting with the free-list head keeps readers from taking the
+        # section for a mis-numbered table
+        out.write(b'xref\n0 1\n0000000000 65535 f\r\n')
+        for run in self._subsections(sorted(offsets)):
+            out.write(f'{run[0]} {len(run)}\n'.encode())
+            for idnum in run:
+                offset, generation = offsets[idnum]
+                out.write(f'{offset:010d} {generation:05d} n\r\n'.encode())
+        trailer[NameObject('/Size')] = NumberObject(self._next_idnum)
+        out.write(b'trailer\n')
+        trailer.write_to_stream(out)
+        out.write(f'\nstartxref\n{xref_offset}\n%%EOF\n'.encode())
+
+    def _write_xref_stream(self, out, offsets, trailer):
+        # Files using cross-reference streams are updated with one too
+        xref_id = self._next_idnum
+        xref_offset = out.tell()
+        offsets[xref_id] = (xref_offset, 0)
+        rows = io.BytesIO()
+        index = ArrayObject()
+        for run in self._subsections(sorted(offsets)):
+            index.extend([NumberObject(run[0]), NumberObject(len(run))])
+            for idnum in run:
+                offset, generation = offsets[idnum]
+                rows.write(struct.pack('>BQH', 1, offset, generation))
+
+        data = zlib.compress(rows.getvalue())
+        xref = DictionaryObject(trailer)
+        xref.update({
+            NameObject('/Type'): NameObject('/XRef'),
+            NameObject('/Size'): NumberObject(xref_id + 1),
+            NameObject('/Index'): index,
+            NameObject('/W'): ArrayObject([NumberObject(1), NumberObject(8), NumberObject(2)]),
+            NameObject('/Filter'): NameObject('/FlateDecode'),
+            NameObject('/Length'): NumberObject(len(data)),
+        })
+        out.write(f'{xref_id} 0 obj\n'.encode())
+        xref.write_to_stream(out)
+        out.write(b'\nstream\n')
+        out.write(data)
+        out.write(b'\nendstream\nendobj\n')
+        out.write(f'startxref\n{xref_offset}\n%%EOF\n'.encode())
@@ -0,0 +1,207 @@
+"""
+Sending read-heavy views' queries to read replicas.
+
+Replicas are the aliases in settings.DATABASE_REPLICAS. Queries only go
+to one inside views decorated with @replica_reads, and only when it is
+safe to read slightly stale data:
+
+- not after the request itself wrote something, since it must see its
+  own writes;
+- not for REPLICA_PIN_SECONDS after the same client made a write, which
+  ReplicaPinMiddleware remembers in a cookie, so that e.g. the dashboard
+  shown after an upload includes the new document;
+- not to a replica that couldn't be connected to in the last
+  REPLICA_RETRY_SECONDS. When none is available, the primary serves the
+  reads;
+- not for the cached session user (see primary_reads()).
+
+Other values computed from a replica may be cached, but only for
+REPLICA_PIN_SECONDS (see track_reads()): a lagging replica's answer would
+otherwise outlive the lag.
+"""
+import functools
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger('mainapp.routers')
+
+PIN_COOKIE = 'primary_pin'
+
+# app_label of the model DatabaseCache queries through
+CACHE_APP_LABEL = 'django_cache'
+
+
+class RoutingState:
+    """
+    Per-request routing decisions. Shared, not copied, with the threads a
+    request hands work to, so writes made there are seen here.
+    """
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.use_replicas = False
+        self.wrote = False
+        self.replica_reads = 0
+
+
+_state = ContextVar('replica_routing_state', default=None)
+
+# alias -> time.monotonic() before which the replica isn't tried again
+_down_until = {}
+_down_lock = threading.Lock()
+
+
+@contextmanager
+def routing_request(request):
+    """
+    Track routing state for ``request`` for the duration of the block.
+    """
+    state = RoutingState(pinned=PIN_COOKIE in request.COOKIES)
+    token = _state.set(state)
+    try:
+        yield state
+    finally:
+        _state.reset(token)
+
+
+@contextmanager
+def _replicas_enabled():
+    state = _state.get()
+    token = None
+    if state is None:
+        # Not under ReplicaPinMiddleware; nothing to pin, but still route
+        state = RoutingState()
+        token = _state.set(state)
+    previous, state.use_replicas = state.use_replicas, True
+    try:
+        yield
+    finally:
+        state.use_replicas = previous
+        if token is not None:
+            _state.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    """
+    Send the block's reads to the primary even in a @replica_reads view,
+    e.g. to load a value that is cached for long and must not be stale.
+    """
+    state = _state.get()
+    if state is None:
+        yield
+        return
+    previous, state.use_replicas = state.use_replicas, False
+    try:
+        yield
+    finally:
+        state.use_replicas = previous
+
+
+class ReadTracker:
+    replica = False
+
+    def cache_timeout(self, timeout):
+        """
+        How long to cache a value computed by the tracked block: ``timeout``,
+        or at most REPLICA_PIN_SECONDS if it was read from a replica, which
+        may have been lagging (e.g. behind the version it's cached under).
+        """
+        return min(timeout, settings.REPLICA_PIN_SECONDS) if self.replica else timeout
+
+
+@contextmanager
+def track_reads():
+    """
+    Yield a ReadTracker whose ``replica`` is set after the block if any of
+    its reads (in this request, on any thread) went to a replica.
+    """
+    state = _state.get()
+    tracker = ReadTracker()
+    before = state.replica_reads if state is not None else 0
+    try:
+        yield tracker
+    finally:
+        tracker.replica = state is not None and state.replica_reads > before
+
+
+def replica_reads(view):
+    """
+    Let the view's read queries go to a replica when one is safe to use.
+    """
+    if iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            with _replicas_enabled():
+                return await view(request, *args, **kwargs)
+    else:
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            with _replicas_enabled():
+                return view(request, *args, **kwargs)
+    return wrapper
+
+
+def mark_down(alias):
+    with _down_lock:
+        _down_until[alias] = time.monotonic() + settings.REPLICA_RETRY_SECONDS
+    logger.warning('replica unavailable alias=%s retry_in=%ss', alias, settings.REPLICA_RETRY_SECONDS)
+
+
+def available_replica():
+    """
+    A replica that isn't marked down and that this thread can connect to,
+    or None.
+    """
+    now = time.monotonic()
+    candidates = [alias for alias in settings.DATABASE_REPLICAS if _down_until.get(alias, 0) <= now]
+    random.shuffle(candidates)
+    for alias in candidates:
+        try:
+            connections[alias].ensure_connection()
+        except DatabaseError:
+            mark_down(alias)
+            continue
+        return alias
+    return None
+
+
+class ReplicaRouter:
+    """
+    Route reads to a replica as described above; everything else, and all
+    migrations, to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or not state.use_replicas or state.pinned or state.wrote:
+            return None
+        if model._meta.app_label == CACHE_APP_LABEL:
+            # A lagging replica could return entries already invalidated
+            return None
+        alias = available_replica()
+        if alias is not None:
+            state.replica_reads += 1
+        return alias
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        # Filling the database cache doesn't change what the client sees
+        if state is not None and model._meta.app_label != CACHE_APP_LABEL:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
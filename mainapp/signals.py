@@ -0,0 +1,61 @@
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import auth, fragments, stats
+from .models import Document, Signature, UserKey, Users
+from .storage import delete_on_commit
+
+
+@receiver(post_delete, sender=Document)
+def release_document_files(sender, instance, **kwargs):
+    # Drop this row's references so unreferenced blobs are removed
+    for field_file in (instance.file, instance.signed_file):
+        delete_on_commit(field_file.storage, field_file.name)
+
+
+@receiver(post_delete, sender=Signature)
+def release_signature_image(sender, instance, **kwargs):
+    delete_on_commit(instance.image.storage, instance.image.name)
+
+
+@receiver(post_init, sender=Document)
+def remember_document_state(sender, instance, **kwargs):
+    stats.remember(instance)
+
+
+@receiver(post_save, sender=Document)
+def count_saved_document(sender, instance, created, **kwargs):
+    stats.document_saved(instance, created)
+
+
+@receiver(pre_delete, sender=Document)
+def uncount_deleted_document(sender, instance, **kwargs):
+    # Before release_document_files, while the files' sizes can be read
+    stats.document_deleted(instance)
+
+
+@receiver(post_save, sender=Document)
+def invalidate_document_fragments(sender, instance, **kwargs):
+    fragments.documents_changed(instance.user_id, instance.updated_at.timestamp())
+
+
+@receiver(post_delete, sender=Document)
+@receiver(post_save, sender=UserKey)
+@receiver(post_delete, sender=UserKey)
+def invalidate_after_change(sender, instance, **kwargs):
+    # Deleted documents and changed keys alter what verification reports
+    fragments.documents_changed(instance.user_id)
+
+
+@receiver(post_save, sender=Users)
+@receiver(post_delete, sender=Users)
+def forget_cached_user(sender, instance, **kwargs):
+    auth.forget_user(instance.pk)
+
+
+@receiver(post_save, sender=UserKey)
+@receiver(post_delete, sender=UserKey)
+@receiver(post_save, sender=Signature)
+@receiver(post_delete, sender=Signature)
+def forget_user_profile(sender, instance, **kwargs):
+    auth.forget_profile(instance.user_id)
@@ -0,0 +1,141 @@
+"""
+Per-user document statistics without counting documents.
+
+UserStats holds running totals for each user. The Document signal
+handlers in mainapp.signals apply the difference each save or delete
+makes with F() expressions, so concurrent requests add up rather than
+overwrite each other, and showing the totals reads one row however many
+documents a user has.
+
+A save is compared with the state the Document was loaded or last saved
+with, which remember() records. A user's row is created by counting their
+documents the first time it is needed; `manage.py rebuild_user_stats`
+recounts them, e.g. after documents were changed with update().
+"""
+from django.db.models import Count, F, Q
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+FILE_FIELDS = ('file', 'signed_file')
+
+
+def _file_size(storage, name):
+    if not name:
+        return 0
+    try:
+        return storage.size(name)
+    except OSError:
+        return 0
+
+
+def _loaded(document, field):
+    """
+    The stored value of ``field`` (a file's name), or None when the field
+    was deferred and so isn't known without a query.
+    """
+    if field not in document.__dict__:
+        return None
+    value = document.__dict__[field]
+    return getattr(value, 'name', value) or ''
+
+
+def remember(document):
+    document._stats_state = {field: _loaded(document, field) for field in (*FILE_FIELDS, 'signature_data')}
+
+
+def contribution(document):
+    """
+    What ``document`` adds to its user's totals.
+    """
+    return {
+        'documents': 1,
+        'signed': int(bool(document.signed_file)),
+        'crypto_signed': int(bool(document.signature_data)),
+        'bytes_stored': sum(
+            _file_size(getattr(document, field).storage, getattr(document, field).name) for field in FILE_FIELDS
+        ),
+    }
+
+
+def apply(user_id, changes):
+    """
+    Add ``changes`` ({field: difference}) to the user's totals. Users
+    without a row yet are skipped; theirs is counted when first needed.
+    """
+    from .models import UserStats
+
+    changes = {field: difference for field, difference in changes.items() if difference}
+    if not changes:
+        return
+    UserStats.objects.filter(user_id=user_id).update(
+        updated_at=timezone.now(),
+        # Never below zero, even if the totals have drifted
+        **{field: Greatest(F(field) + difference, 0) for field, difference in changes.items()},
+    )
+
+
+def document_saved(document, created):
+    if created:
+        apply(document.user_id, contribution(document))
+        remember(document)
+        return
+
+    old = getattr(document, '_stats_state', {})
+    changes = {'bytes_stored': 0}
+    for field in FILE_FIELDS:
+        old_name, new_name = old.get(field), _loaded(document, field)
+        if old_name is None or new_name is None or old_name == new_name:
+            continue
+        storage = getattr(document, field).storage
+        changes['bytes_stored'] += _file_size(storage, new_name) - _file_size(storage, old_name)
+        if field == 'signed_file':
+            changes['signed'] = bool(new_name) - bool(old_name)
+    old_signature, new_signature = old.get('signature_data'), _loaded(document, 'signature_data')
+    if old_signature is not None and new_signature is not None:
+        changes['crypto_signed'] = bool(new_signature) - bool(old_signature)
+    apply(document.user_id, changes)
+    remember(document)
+
+
+def document_deleted(document):
+    apply(document.user_id, {field: -value for field, value in contribution(document).items()})
+
+
+def count(user_id):
+    """
+    The user's totals, counted from their documents.
+    """
+    from .models import Document
+
+    documents = Document.objects.filter(user_id=user_id)
+    totals = documents.aggregate(
+        documents=Count('pk'),
+        signed=Count('pk', filter=Q(signed_file__isnull=False) & ~Q(signed_file='')),
+        crypto_signed=Count('pk', filter=Q(signature_data__isnull=False) & ~Q(signature_data='')),
+    )
+    storage = Document._meta.get_field('file').storage
+    totals['bytes_stored'] = sum(
+        _file_size(storage, name)
+        for names in documents.values_list(*FILE_FIELDS).iterator()
+        for name in names
+    )
+    return totals
+
+
+def rebuild(user_id):
+    from .models import UserStats
+
+    stats, _ = UserStats.objects.update_or_create(user_id=user_id, defaults=count(user_id))
+    return stats
+
+
+def get_user_stats(user_id):
+    """
+    The user's UserStats, counted and created if they don't have one yet.
+    """
+    from .models import UserStats
+
+    try:
+        return UserStats.objects.get(user_id=user_id)
+    except UserStats.DoesNotExist:
+        return rebuild(user_id)
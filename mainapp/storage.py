@@ -0,0 +1,119 @@
+import hashlib
+import os
+import tempfile
+
+from django.apps import apps
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.db.models import F
+
+BLOB_PREFIX = 'blobs/'
+
+
+def blob_name(sha256, ext=''):
+    """
+    Storage name of a blob, sharded on the leading hex digits of its hash,
+    e.g. blobs/ab/cd/abcd...ef.pdf.
+    """
+    return f'{BLOB_PREFIX}{sha256[:2]}/{sha256[2:4]}/{sha256}{ext}'
+
+
+def is_blob_name(name):
+    return bool(name) and name.startswith(BLOB_PREFIX)
+
+
+def delete_on_commit(storage, name):
+    """
+    Delete ``name`` from ``storage`` (for blobs, drop one reference to it)
+    once the current transaction commits, so a rollback leaves the file for
+    the row that still names it.
+    """
+    if name:
+        transaction.on_commit(lambda: storage.delete(name))
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File system storage that keeps each distinct content once.
+
+    Saved files are named after the SHA256 of their content, so identical
+    uploads resolve to the same blob (one per content and extension). A
+    StoredBlob row counts the references to each blob; delete() only
+    removes the file once the last reference is gone. Names saved before
+    this storage was introduced are handled like plain FileSystemStorage.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        # Names are derived from content in _save, so the requested name
+        # never needs a uniqueness suffix.
+        return name
+
+    def _save(self, name, content):
+        ext = os.path.splitext(name)[1].lower()
+        staged_path = None
+        # Set by callers that hashed the content as it arrived
+        digest = getattr(content, 'sha256', None)
+
+        if hasattr(content, 'temporary_file_path'):
+            # Already on disk: hash it in place so it can be moved, not copied
+            source_path = content.temporary_file_path()
+            if digest is None:
+                sha256 = hashlib.sha256()
+                with open(source_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(64 * 1024), b''):
+                        sha256.update(chunk)
+                digest = sha256.hexdigest()
+        else:
+            # Stream the content to a staging file, hashing as it is written
+            staging_dir = self.path(f'{BLOB_PREFIX}tmp')
+            os.makedirs(staging_dir, exist_ok=True)
+            sha256 = hashlib.sha256()
+            fd, staged_path = tempfile.mkstemp(dir=staging_dir)
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    if digest is None:
+                        sha256.update(chunk)
+                    out.write(chunk)
+            source_path = staged_path
+            digest = digest or sha256.hexdigest()
+
+        name = blob_name(digest, ext)
+        full_path = self.path(name)
+
+        StoredBlob = apps.get_model('mainapp', 'StoredBlob')
+        with transaction.atomic():
+            blob, created = StoredBlob.objects.select_for_update().get_or_create(
+                name=name,
+                defaults={'sha256': digest, 'size': os.path.getsize(source_path), 'refcount': 1},
+            )
+            if not created:
+                StoredBlob.objects.filter(pk=blob.pk).update(refcount=F('refcount') + 1)
+
+            if not os.path.exists(full_path):
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                file_move_safe(source_path, full_path)
+                if self.file_permissions_mode is not None:
+                    os.chmod(full_path, self.file_permissions_mode)
+            else:
+                # Already stored: drop this copy as the move would have,
+                # whether it was staged here or handed over on disk
+                os.remove(source_path)
+        return name
+
+    def delete(self, name):
+        if not is_blob_name(name):
+            return super().delete(name)
+
+        StoredBlob = apps.get_model('mainapp', 'StoredBlob')
+        with transaction.atomic():
+            blob = StoredBlob.objects.select_for_update().filter(name=name).first()
+            if blob is None:
+                return super().delete(name)
+            if blob.refcount > 1:
+                StoredBlob.objects.filter(pk=blob.pk).update(refcount=F('refcount') - 1)
+                return
+            blob.delete()
+            super().delete(name)
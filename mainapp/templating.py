@@ -0,0 +1,89 @@
+"""
+Compiling templates ahead of the requests that render them.
+
+TEMPLATES wraps the filesystem and app directories loaders in the cached
+loader, so each template is parsed once per process. warm_templates()
+does that for every template up front, e.g. in gunicorn's master process
+so that its forked workers start with all of them compiled.
+"""
+import os
+
+from django.template import Engine, TemplateSyntaxError, engines
+
+TEMPLATE_EXTENSIONS = ('.html', '.txt')
+
+CACHED_LOADER = 'django.template.loaders.cached.Loader'
+
+
+def get_engine():
+    return engines['django'].engine
+
+
+def source_loaders(engine):
+    """
+    The loaders that read templates from disk, unwrapped from the cached
+    loader if it is in use.
+    """
+    loaders = []
+    for loader in engine.template_loaders:
+        loaders.extend(getattr(loader, 'loaders', [loader]))
+    return loaders
+
+
+def template_names(engine=None):
+    """
+    Names of all templates the engine can load, in lookup order.
+    """
+    engine = engine or get_engine()
+    names = {}
+    for loader in source_loaders(engine):
+        for directory in loader.get_dirs():
+            directory = str(directory)
+            for root, _, files in os.walk(directory):
+                for filename in sorted(files):
+                    if filename.endswith(TEMPLATE_EXTENSIONS):
+                        name = os.path.relpath(os.path.join(root, filename), directory)
+                        names.setdefault(name.replace(os.sep, '/'), None)
+    return list(names)
+
+
+def warm_templates(engine=None):
+    """
+    Compile every template into the cached loader. Returns the names
+    compiled and {name: error} for those that don't compile.
+    """
+    engine = engine or get_engine()
+    compiled, errors = [], {}
+    for name in template_names(engine):
+        try:
+            engine.get_template(name)
+        except TemplateSyntaxError as e:
+            # Most likely a template of an app that isn't fully installed;
+            # it only matters if something renders it
+            errors[name] = e
+        else:
+            compiled.append(name)
+    return compiled, errors
+
+
+def uncached_engine(engine=None):
+    """
+    A copy of the engine that loads and parses templates on every lookup,
+    as the engine did without the cached loader.
+    """
+    engine = engine or get_engine()
+    return Engine(
+        dirs=engine.dirs,
+        context_processors=engine.context_processors,
+        debug=engine.debug,
+        loaders=[
+            spec
+            for loader in engine.loaders
+            for spec in (loader[1] if isinstance(loader, (list, tuple)) and loader[0] == CACHED_LOADER else [loader])
+        ],
+        string_if_invalid=engine.string_if_invalid,
+        file_charset=engine.file_charset,
+        libraries=engine.libraries,
+        builtins=[name for name in engine.builtins if name not in Engine.default_builtins],
+        autoescape=engine.autoescape,
+    )
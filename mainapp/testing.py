@@ -0,0 +1,48 @@
+from contextlib import contextmanager
+
+from django.urls import reverse
+
+from .middleware import recording_queries
+
+# Maximum number of queries each view may run for a typical request with
+# nothing cached, including session and user loading; ViewQueryBudgetTests
+# checks them. Raise a budget deliberately, not to make a failing test pass.
+VIEW_QUERY_BUDGETS = {
+    'login': 7,             # POST, creating the session
+    'dashboard': 6,
+    'upload_signature': 3,
+    'upload_document': 2,
+    'sign_document': 10,    # POST, storing the signed file
+    'verify_document': 5,   # POST of a signed document
+    'api_token': 7,
+}
+
+
+@contextmanager
+def query_budget(budget, using=None):
+    """
+    Fail with an AssertionError if the block runs more than ``budget``
+    queries, counting those async views run on other threads. ``using``
+    restricts the count to one database alias.
+    """
+    with recording_queries() as recorder:
+        yield recorder
+    count = recorder.count if using is None else recorder.count_for(using)
+    if count > budget:
+        queries = '\n'.join(f'  {n} x {shape}' for shape, n in recorder.shapes.items())
+        raise AssertionError(
+            f'{count} queries executed, budget is {budget}:\n{queries}'
+        )
+
+
+def assert_view_query_budget(client, view_name, *args, method='get', data=None, budget=None, **kwargs):
+    """
+    Request ``view_name`` with the test client and check it stays within its
+    budget from VIEW_QUERY_BUDGETS (or the explicit ``budget``).
+    """
+    if budget is None:
+        budget = VIEW_QUERY_BUDGETS[view_name]
+    url = reverse(view_name, args=args, kwargs=kwargs)
+    with query_budget(budget):
+        response = getattr(client, method)(url, data)
+    return response
@@ -1,3 +1,971 @@
-from django.test import TestCase
+import base64
+import hashlib
+import io
+import os
+import tempfile
+import time
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections
+from asgiref.sync import async_to_sync
+from PIL import Image, ImageDraw
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import RectangleObject
+from django.http import HttpResponse
+from django.conf import settings
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings, tag
+from django.urls import reverse
+from django.utils import timezone
+
+from . import chunked, fragments, routers, stats, views
+from .downloads import serve_file
+from .offload import run_blocking, run_cpu
+from .timing import timed_view
+from .forms import DocumentForm
+from .uploads import RequestBodyLimit
+from .management.commands import check_import_time, stress_sqlite
+from .middleware import ReplicaPinMiddleware, recording_queries
+from .models import ApiToken, ChunkedUpload, Document, Organizations, Signature, StoredBlob, UserKey, Users, UserStats
+from .testing import assert_view_query_budget
+from .utils import (
+    encrypt_private_key, generate_key_pair, normalize_signature_image, parse_placements, sign_hash, sign_pdf,
+)
+
+
+def make_user(username, **fields):
+    user = Users(
+        username=username, email=f'{username}@example.com', first_name=username, last_name='Test',
+        contact=Users.objects.count() + 1000, **fields,
+    )
+    user.set_password('correct horse battery')
+    user.save()
+    return user
+
+
+class QueryPlanTests(TestCase):
+    def test_hot_queries_use_indexes(self):
+        if connection.vendor not in ('sqlite', 'postgresql'):
+            self.skipTest(f'Query plan checks are not supported on {connection.vendor}.')
+        # Raises CommandError naming the queries that scan a whole table
+        call_command('check_query_plans', stdout=StringIO())
+
+
+@override_settings(
+    AUTHENTICATION_BACKENDS=['mainapp.auth.CachedModelBackend'],
+    SESSION_ENGINE='django.contrib.sessions.backends.cached_db',
+)
+class CachedAuthTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = make_user('alice')
+        self.client.force_login(self.user)
+        # Caches the session and its user
+        self.assertEqual(self.client.get(reverse('dashboard')).status_code, 200)
+
+    def test_password_change_ends_session(self):
+        self.user.set_password('another horse battery')
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('dashboard')).status_code, 302)
+
+    def test_deactivation_ends_session(self):
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('dashboard')).status_code, 302)
+
+
+# Passes the upload checks on the first part and on the last bytes
+PDF_CONTENT = b'%PDF-1.4\n' + b'0' * 4000 + b'\nstartxref\n0\n%%EOF\n'
+
+
+class ChunkedUploadTests(TestCase):
+    """
+    The tus upload endpoints, with a temporary directory standing in for
+    MEDIA_ROOT and the staging directory.
+    """
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.staging_dir = os.path.join(tmp.name, 'staging')
+        self.enterContext(override_settings(MEDIA_ROOT=tmp.name, CHUNKED_UPLOAD_DIR=self.staging_dir))
+        chunked._running_hashes.clear()
+        self.user = make_user('carol')
+        self.client.force_login(self.user)
+
+    def post(self, content=PDF_CONTENT, **metadata):
+        metadata = ','.join(f'{key} {base64.b64encode(value.encode()).decode()}' for key, value in metadata.items())
+        return self.client.post(
+            reverse('chunked_upload_create'),
+            headers={'Tus-Resumable': chunked.TUS_VERSION, 'Upload-Length': str(len(content)), 'Upload-Metadata': metadata},
+        )
+
+    def create(self, content=PDF_CONTENT, filename='report.pdf'):
+        response = self.post(content, filename=filename)
+        self.assertEqual(response.status_code, 201)
+        return response['Location']
+
+    def expire(self, upload_ids):
+        past = timezone.now() - timezone.timedelta(seconds=settings.CHUNKED_UPLOAD_EXPIRY_SECONDS + 1)
+        ChunkedUpload.objects.filter(upload_id__in=upload_ids).update(updated_at=past)
+
+    def patch(self, location, part, offset, checksum=None):
+        headers = {'Tus-Resumable': chunked.TUS_VERSION, 'Upload-Offset': str(offset)}
+        if checksum is not None:
+            headers['Upload-Checksum'] = f'sha256 {base64.b64encode(checksum).decode()}'
+        return self.client.patch(location, part, content_type='application/offset+octet-stream', headers=headers)
+
+    def offset(self, location):
+        response = self.client.head(location)
+        self.assertEqual(response.status_code, 200)
+        return int(response['Upload-Offset'])
+
+    def upload(self, content=PDF_CONTENT, part_size=1000):
+        location = self.create(content)
+        for offset in range(0, len(content), part_size):
+            response = self.patch(location, content[offset:offset + part_size], offset)
+            self.assertEqual(response.status_code, 204)
+        return response
+
+    def test_create(self):
+        location = self.create()
+        upload = ChunkedUpload.objects.get()
+        self.assertEqual(location, reverse('chunked_upload_detail', args=[upload.upload_id]))
+        self.assertEqual((upload.filename, upload.length, upload.offset), ('report.pdf', len(PDF_CONTENT), 0))
+
+    def test_patch_appends_parts(self):
+        location = self.create()
+        response = self.patch(location, PDF_CONTENT[:1000], 0)
+        self.assertEqual((response.status_code, response['Upload-Offset']), (204, '1000'))
+        self.assertEqual(self.patch(location, PDF_CONTENT[1000:2000], 1000)['Upload-Offset'], '2000')
+        upload = ChunkedUpload.objects.get()
+        self.assertEqual(len(upload.part_hashes), 2)
+        with open(chunked.staging_path(upload), 'rb') as f:
+            self.assertEqual(f.read(), PDF_CONTENT[:2000])
+
+    def test_offset(self):
+        location = self.create()
+        self.assertEqual(self.offset(location), 0)
+        self.patch(location, PDF_CONTENT[:1500], 0)
+        self.assertEqual(self.offset(location), 1500)
+        self.assertEqual(self.patch(location, PDF_CONTENT[:1000], 0).status_code, 409)
+
+    def test_resume_after_rejected_part(self):
+        location = self.create()
+        self.patch(location, PDF_CONTENT[:1000], 0)
+        response = self.patch(location, PDF_CONTENT[1000:2000], 1000, checksum=b'wrong')
+        self.assertEqual(response.status_code, 460)
+        self.assertEqual(self.offset(location), 1000)
+        # Continued by another worker, without this one's running hash
+        chunked._running_hashes.clear()
+        self.patch(location, PDF_CONTENT[1000:], 1000, checksum=hashlib.sha256(PDF_CONTENT[1000:]).digest())
+        document = Document.objects.get()
+        self.assertEqual(document.original_hash, hashlib.sha256(PDF_CONTENT).hexdigest())
+        with document.file.open('rb') as f:
+            self.assertEqual(f.read(), PDF_CONTENT)
+
+    def test_complete(self):
+        response = self.upload()
+        document = Document.objects.get()
+        self.assertEqual(response['Upload-Document'], str(document.id))
+        self.assertEqual((document.user, document.title), (self.user, 'report.pdf'))
+        self.assertEqual(ChunkedUpload.objects.get().document, document)
+        self.assertEqual(os.listdir(self.staging_dir), [])
+
+    def test_metadata_longer_than_fields_is_refused(self):
+        for field in ('filename', 'title'):
+            with self.subTest(field=field):
+                response = self.post(**{field: 'x' * 252 + '.pdf'})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn(field, response['Upload-Error'])
+        self.assertFalse(ChunkedUpload.objects.exists())
+
+    def test_expiration(self):
+        location = self.create()
+        response = self.patch(location, PDF_CONTENT[:1000], 0)
+        self.assertIn('Upload-Expires', response)
+        self.assertIn('expiration', self.client.options(reverse('chunked_upload_create'))['Tus-Extension'])
+
+        self.expire([ChunkedUpload.objects.get().upload_id])
+        self.assertEqual(self.patch(location, PDF_CONTENT[1000:2000], 1000).status_code, 410)
+        self.assertFalse(ChunkedUpload.objects.exists())
+        self.assertEqual(os.listdir(self.staging_dir), [])
+
+    def test_expire_command(self):
+        for _ in range(2):
+            self.patch(self.create(), PDF_CONTENT[:1000], 0)
+        expired, active = ChunkedUpload.objects.order_by('pk')
+        self.expire([expired.upload_id])
+        self.upload()
+        # Left behind by an upload whose row is gone
+        orphan = os.path.join(self.staging_dir, 'orphan.part')
+        open(orphan, 'wb').close()
+        os.utime(orphan, (0, 0))
+
+        out = StringIO()
+        call_command('expire_chunked_uploads', stdout=out)
+        self.assertIn('Removed 1 expired uploads and 1 staging files', out.getvalue())
+        self.assertEqual(list(ChunkedUpload.objects.filter(document__isnull=True)), [active])
+        self.assertEqual(ChunkedUpload.objects.filter(document__isnull=False).count(), 1)
+        self.assertEqual(os.listdir(self.staging_dir), [f'{active.upload_id}.part'])
+
+    def test_duplicate_content_shares_blob_and_removes_staging_file(self):
+        self.upload()
+        self.upload()
+        first, second = Document.objects.all()
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(StoredBlob.objects.get().refcount, 2)
+        self.assertEqual(os.listdir(self.staging_dir), [])
+
+
+class UploadValidationTests(TransactionTestCase):
+    """
+    Document uploads checked by PDFUploadHandler as they stream in. The
+    upload view saves from a pool thread, which only sees committed rows.
+    """
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=tmp.name, PDF_UPLOAD_MAX_BYTES=10000))
+        self.user = make_user('heidi')
+        self.client.force_login(self.user)
+        self.organization = Organizations.objects.create(name='Example')
+
+    def make_token(self, user, max_upload_bytes, days=10):
+        return ApiToken.objects.create(
+            user=user, token=f'token-{user.username}-{days}', expires_at=timezone.now() + timezone.timedelta(days=days),
+            description='CI', organization=self.organization, max_upload_bytes=max_upload_bytes,
+        ).token
+
+    def upload(self, content, token=None):
+        """
+        Upload ``content`` and return the form errors for the file, or None
+        if a Document was created.
+        """
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        response = self.client.post(
+            reverse('upload_document'),
+            {'title': 'contract', 'file': SimpleUploadedFile('contract.pdf', content)},
+            headers=headers,
+        )
+        if response.status_code == 302:
+            self.assertTrue(Document.objects.exists())
+            return None
+        self.assertFalse(Document.objects.exists())
+        return ' '.join(response.context['form'].errors['file'])
+
+    def test_pdf_is_accepted(self):
+        self.assertIsNone(self.upload(PDF_CONTENT))
+
+    def test_upload_is_hashed_once(self):
+        digest = hashlib.sha256(PDF_CONTENT).hexdigest()
+        # Kept in memory, and spooled to a temporary file
+        for memory_size in (settings.FILE_UPLOAD_MAX_MEMORY_SIZE, 0):
+            with (
+                self.subTest(memory_size=memory_size),
+                override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=memory_size),
+                mock.patch.object(views, 'hash_chunks') as hash_chunks,
+                mock.patch('mainapp.storage.hashlib') as storage_hashlib,
+            ):
+                self.assertIsNone(self.upload(PDF_CONTENT))
+                hash_chunks.assert_not_called()
+                storage_hashlib.sha256.return_value.update.assert_not_called()
+                document = Document.objects.get()
+                self.assertEqual(document.original_hash, digest)
+                self.assertIn(digest, document.file.name)
+                document.delete()
+
+    def test_non_pdf_header_is_skipped(self):
+        self.assertIn('is not a PDF document', self.upload(b'GIF89a' + b'0' * 4000))
+
+    def test_missing_trailer_is_rejected(self):
+        self.assertIn('truncated or corrupt', self.upload(PDF_CONTENT[:-100]))
+
+    def test_oversized_upload_is_aborted(self):
+        self.assertIn('too large', self.upload(PDF_CONTENT + b'0' * 10000))
+
+    def test_user_limit(self):
+        Users.objects.filter(pk=self.user.pk).update(max_upload_bytes=2000)
+        self.assertIn('too large', self.upload(PDF_CONTENT))
+
+    def test_own_token_limit(self):
+        Users.objects.filter(pk=self.user.pk).update(max_upload_bytes=2000)
+        self.assertIsNone(self.upload(PDF_CONTENT, token=self.make_token(self.user, 10000)))
+
+    def test_other_users_and_expired_tokens_are_ignored(self):
+        Users.objects.filter(pk=self.user.pk).update(max_upload_bytes=2000)
+        self.assertIn('too large', self.upload(PDF_CONTENT, token=self.make_token(make_user('ivan'), 10000)))
+        self.assertIn('too large', self.upload(PDF_CONTENT, token=self.make_token(self.user, 10000, days=-1)))
+
+    def test_form_checks_files_that_bypassed_the_handler(self):
+        form = DocumentForm(
+            {'title': 'contract'}, {'file': SimpleUploadedFile('contract.pdf', PDF_CONTENT[:-100])},
+            max_upload_bytes=10000,
+        )
+        self.assertIn('PDF document is truncated or corrupt.', form.errors['file'])
+        form = DocumentForm(
+            {'title': 'contract'}, {'file': SimpleUploadedFile('contract.pdf', PDF_CONTENT)}, max_upload_bytes=1000,
+        )
+        self.assertIn('too large', form.errors['file'][0])
+
+
+class SignatureImageTests(SimpleTestCase):
+    def normalize(self, img):
+        data = io.BytesIO()
+        img.save(data, format='PNG')
+        result = normalize_signature_image(SimpleUploadedFile('signature.png', data.getvalue()))
+        self.assertEqual(result.name, 'signature.png')
+        return Image.open(io.BytesIO(result.read()))
+
+    def draw_signature(self, mode, background):
+        # A wide stroke in the middle of a screenshot-sized canvas
+        img = Image.new(mode, (1920, 1080), background)
+        ImageDraw.Draw(img).line([(800, 500), (1100, 560)], fill=(0, 0, 0, 255), width=8)
+        return img
+
+    def test_opaque_rgba_is_cropped_to_the_ink_and_quantized(self):
+        result = self.normalize(self.draw_signature('RGBA', (255, 255, 255, 255)))
+        self.assertEqual(result.mode, 'P')
+        self.assertNotIn('transparency', result.info)
+        # Cropped to the stroke, about 5:1, not the 16:9 screen
+        self.assertGreater(result.width / result.height, 3)
+
+    def test_transparent_background_is_kept(self):
+        result = self.normalize(self.draw_signature('RGBA', (255, 255, 255, 0)))
+        self.assertEqual(result.mode, 'RGBA')
+        self.assertGreater(result.width / result.height, 3)
+        self.assertEqual(result.getpixel((0, 0))[3], 0)
+
+
+class SigningTestCase(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        self.signature = os.path.join(self.dir, 'signature.png')
+        img = Image.new('RGBA', (300, 100), (255, 255, 255, 0))
+        ImageDraw.Draw(img).line([(10, 50), (290, 60)], fill=(0, 0, 0, 255), width=5)
+        img.save(self.signature)
+
+    def sign(self, pages, first_mediabox=None, **kwargs):
+        """
+        Sign a blank document of ``pages`` pages. Returns (input size,
+        output size, PdfReader of the output).
+        """
+        writer = PdfWriter()
+        for _ in range(pages):
+            writer.add_blank_page(612, 792)
+        if first_mediabox:
+            writer.pages[0].mediabox = RectangleObject(first_mediabox)
+        original = os.path.join(self.dir, f'{pages}.pdf')
+        signed = os.path.join(self.dir, f'{pages}-signed.pdf')
+        writer.write(original)
+        sign_pdf(original, self.signature, signed, **kwargs)
+        return os.path.getsize(original), os.path.getsize(signed), PdfReader(signed)
+
+    def draw_operators(self, page):
+        return page['/Contents'][-1].get_object().get_data()
+
+
+class StampingTests(SigningTestCase):
+    def test_all_pages_share_one_form_xobject(self):
+        small_in, small_out, _ = self.sign(5, all_pages=True)
+        large_in, large_out, reader = self.sign(50, all_pages=True)
+        forms = {page['/Resources']['/XObject'].raw_get('/DigiSig').idnum for page in reader.pages}
+        self.assertEqual(len(forms), 1)
+        for page in reader.pages:
+            self.assertEqual(self.draw_operators(page), b'Q q /DigiSig Do Q\n')
+        # Each further page only gains references: far less than the overlay
+        per_page = ((large_out - large_in) - (small_out - small_in)) / 45
+        self.assertLess(per_page, 300)
+        self.assertGreater(small_out - small_in, 2 * per_page * 5)
+
+    def test_page_not_at_origin(self):
+        _, _, reader = self.sign(2, first_mediabox=[100, 100, 712, 892], all_pages=True)
+        self.assertEqual(self.draw_operators(reader.pages[0]), b'Q q 1 0 0 1 100 100 cm /DigiSig Do Q\n')
+        self.assertEqual(self.draw_operators(reader.pages[1]), b'Q q /DigiSig Do Q\n')
+
+
+class PlacementTests(SigningTestCase):
+    def test_default_placement_is_on_the_last_page_only(self):
+        _, _, reader = self.sign(3)
+        self.assertNotIn('/XObject', reader.pages[0]['/Resources'])
+        self.assertIn('/DigiSig', reader.pages[2]['/Resources']['/XObject'])
+
+    def test_out_of_range_page_raises(self):
+        with self.assertRaisesMessage(ValueError, 'Page 5 is out of range'):
+            self.sign(2, placements=parse_placements([{'page': 5, 'x': 10, 'y': 10}]))
+
+    def test_parse_placements(self):
+        (placement,) = parse_placements([{'x': 10, 'y': '20', 'asset': 'date'}])
+        self.assertEqual(placement, (-1, (10.0, 20.0, 150.0, 50.0), 'date'))
+        self.assertIsNone(parse_placements([{'page': None, 'x': 0, 'y': 0}])[0].page)
+
+    def test_parse_placements_rejects_bad_input(self):
+        for data, message in [
+            ([], 'non-empty list'),
+            ({'x': 1, 'y': 1}, 'non-empty list'),
+            ([{'x': 'left', 'y': 1}], 'numeric x and y'),
+            ([{'y': 1}], 'numeric x and y'),
+            ([{'x': 1, 'y': 1, 'width': 0}], 'positive'),
+            ([{'x': 1, 'y': 1, 'height': -5}], 'positive'),
+            ([{'x': 'nan', 'y': 1}], 'positive'),
+            ([{'x': 1, 'y': 1, 'asset': 'stamp'}], 'Unknown placement asset'),
+            (['x'], 'must be an object'),
+        ]:
+            with self.subTest(data=data), self.assertRaisesMessage(ValueError, message):
+                parse_placements(data)
+
+
+class SignedFileStorageTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.media_root = tmp.name
+        self.enterContext(override_settings(MEDIA_ROOT=self.media_root))
+        self.user = make_user('dave')
+        Signature.objects.create(user=self.user, image='signatures/dave.png')
+        self.client.force_login(self.user)
+
+    def make_document(self, content):
+        document = Document(user=self.user, title='contract', original_hash=hashlib.sha256(content).hexdigest())
+        document.file.save('contract.pdf', ContentFile(content), save=False)
+        document.save()
+        return document
+
+    def blob_files(self):
+        return [name for _, _, files in os.walk(os.path.join(self.media_root, 'blobs')) for name in files]
+
+    def test_resigning_releases_replaced_file(self):
+        # Signed without a visual signature, so every file is the original's blob
+        document = self.make_document(PDF_CONTENT)
+        for _ in range(2):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse('sign_document', args=[document.id]))
+        self.assertEqual(StoredBlob.objects.get(name=document.file.name).refcount, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Document.objects.all().delete()
+        self.assertFalse(StoredBlob.objects.exists())
+        self.assertEqual(self.blob_files(), [])
+
+    def test_files_are_kept_until_delete_commits(self):
+        document = self.make_document(PDF_CONTENT)
+        with self.captureOnCommitCallbacks() as callbacks:
+            document.delete()
+        self.assertEqual(len(self.blob_files()), 1)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.blob_files(), [])
+
+
+class UserStatsTests(TestCase):
+    """
+    The per-user totals kept by the Document signal handlers, compared with
+    a recount after each change.
+    """
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=tmp.name))
+        cache.clear()
+        self.user = make_user('judy')
+        private_pem, public_pem = generate_key_pair()
+        UserKey.objects.create(user=self.user, public_key=public_pem, private_key=encrypt_private_key(private_pem))
+        Signature.objects.create(user=self.user, image='signatures/judy.png')
+        self.client.force_login(self.user)
+
+    def assertStatsMatchCount(self):
+        row = UserStats.objects.get(user=self.user)
+        counted = stats.count(self.user.pk)
+        self.assertEqual({field: getattr(row, field) for field in counted}, counted)
+        return counted
+
+    def upload(self, content, title='contract'):
+        document = Document(user=self.user, title=title, original_hash=hashlib.sha256(content).hexdigest())
+        document.file.save('contract.pdf', ContentFile(content), save=False)
+        document.save()
+        return document
+
+    def sign(self, document):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('sign_document', args=[document.id]))
+        self.assertRedirects(response, reverse('dashboard'), fetch_redirect_response=False)
+
+    def test_missing_row_is_counted(self):
+        self.upload(PDF_CONTENT)
+        self.assertFalse(UserStats.objects.exists())
+        self.assertEqual(stats.get_user_stats(self.user.pk).documents, 1)
+        self.assertStatsMatchCount()
+
+    def test_upload_sign_resign_and_delete(self):
+        stats.get_user_stats(self.user.pk)
+        document = self.upload(PDF_CONTENT)
+        other = self.upload(PDF_CONTENT + b'\n')
+        self.assertEqual(self.assertStatsMatchCount()['documents'], 2)
+
+        self.sign(document)
+        counted = self.assertStatsMatchCount()
+        self.assertEqual((counted['signed'], counted['crypto_signed']), (1, 1))
+        self.sign(document)
+        self.assertEqual(self.assertStatsMatchCount(), counted)
+
+        # Loaded without its file fields, as the dashboard loads documents
+        deferred = Document.objects.only('id', 'user', 'title').get(pk=other.pk)
+        deferred.title = 'renamed'
+        deferred.save()
+        self.assertEqual(self.assertStatsMatchCount(), counted)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Document.objects.get(pk=document.pk).delete()
+        counted = self.assertStatsMatchCount()
+        self.assertEqual((counted['documents'], counted['signed'], counted['crypto_signed']), (1, 0, 0))
+
+    def test_rebuild_corrects_drift(self):
+        stats.get_user_stats(self.user.pk)
+        self.upload(PDF_CONTENT)
+        # update() bypasses the signal handlers
+        Document.objects.update(signature_data='signed elsewhere')
+        self.assertEqual(stats.rebuild(self.user.pk).crypto_signed, 1)
+        self.assertStatsMatchCount()
+
+    def test_dashboard_second_page(self):
+        Document.objects.bulk_create(
+            Document(user=self.user, title=f'contract {i}', file='contract.pdf') for i in range(30)
+        )
+        stats.rebuild(self.user.pk)
+        response = self.client.get(reverse('dashboard'), {'page': 2})
+        self.assertContains(response, 'Showing 26-30 of 30 documents')
+        self.assertContains(response, '<span class="page-link active">2</span>', html=True)
+        self.assertEqual(response.content.decode().count('class="document-name"'), 5)
+
+
+class ViewQueryBudgetTests(TransactionTestCase):
+    """
+    Each view against its VIEW_QUERY_BUDGETS entry, with nothing cached.
+    Async views query from pool threads, which only see committed rows.
+    """
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=tmp.name))
+        self.user = make_user('erin')
+        private_pem, public_pem = generate_key_pair()
+        UserKey.objects.create(user=self.user, public_key=public_pem, private_key=encrypt_private_key(private_pem))
+        Signature.objects.create(user=self.user, image='signatures/erin.png')
+        self.documents = []
+        for i in range(3):
+            content = PDF_CONTENT + str(i).encode()
+            digest = hashlib.sha256(content).hexdigest()
+            document = Document(
+                user=self.user, title=f'contract {i}', original_hash=digest, hash_value=digest,
+                signature_data=sign_hash(digest, private_pem),
+            )
+            document.file.save('contract.pdf', ContentFile(content), save=False)
+            document.save()
+            self.documents.append(document)
+        organization = Organizations.objects.create(name='Example')
+        for i, user in enumerate([self.user, make_user('frank'), make_user('grace')]):
+            ApiToken.objects.create(
+                user=user, token=f'token-{i}', expires_at=timezone.now() + timezone.timedelta(days=10 * i),
+                description='CI', organization=organization,
+            )
+        # Created by the user's first dashboard visit
+        stats.rebuild(self.user.pk)
+        cache.clear()
+
+    def test_login(self):
+        data = {'username': 'erin', 'password': 'correct horse battery'}
+        response = assert_view_query_budget(self.client, 'login', method='post', data=data)
+        self.assertRedirects(response, reverse('dashboard'), fetch_redirect_response=False)
+
+    def test_dashboard(self):
+        self.client.force_login(self.user)
+        self.assertEqual(assert_view_query_budget(self.client, 'dashboard').status_code, 200)
+
+    def test_upload_signature(self):
+        self.client.force_login(self.user)
+        self.assertEqual(assert_view_query_budget(self.client, 'upload_signature').status_code, 200)
+
+    def test_upload_document(self):
+        self.client.force_login(self.user)
+        self.assertEqual(assert_view_query_budget(self.client, 'upload_document').status_code, 200)
+
+    def test_sign_document(self):
+        self.client.force_login(self.user)
+        response = assert_view_query_budget(self.client, 'sign_document', self.documents[0].id, method='post')
+        self.assertRedirects(response, reverse('dashboard'), fetch_redirect_response=False)
+
+    def test_verify_document(self):
+        self.client.force_login(self.user)
+        upload = ContentFile(PDF_CONTENT + b'0', name='contract.pdf')
+        response = assert_view_query_budget(self.client, 'verify_document', method='post', data={'file': upload})
+        self.assertContains(response, 'Valid Cryptographic Signature')
+
+    def test_api_token(self):
+        self.client.force_login(self.user)
+        self.assertEqual(assert_view_query_budget(self.client, 'api_token').status_code, 200)
+
+
+class ServeFileTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'signed.pdf')
+        with open(path, 'wb') as f:
+            f.write(PDF_CONTENT)
+        self.field_file = SimpleNamespace(path=path, name='signed.pdf')
+
+    def get(self, headers=None, **kwargs):
+        request = RequestFactory().get('/', headers=headers)
+        # updated_at timestamps have microseconds
+        return serve_file(request, self.field_file, etag='v1', last_modified=1700000000.75, **kwargs)
+
+    def test_if_modified_since_matches_last_modified(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        self.assertEqual(self.get({'If-Modified-Since': response['Last-Modified']}).status_code, 304)
+
+    def test_if_none_match(self):
+        self.assertEqual(self.get({'If-None-Match': '"v1"'}).status_code, 304)
+        response = self.get({'If-None-Match': '"v0"'})
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+    def test_range(self):
+        response = self.get({'Range': 'bytes=5-14'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 5-14/{len(PDF_CONTENT)}')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(b''.join(response.streaming_content), PDF_CONTENT[5:15])
+
+    def test_suffix_range(self):
+        size = len(PDF_CONTENT)
+        response = self.get({'Range': 'bytes=-20'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes {size - 20}-{size - 1}/{size}')
+        self.assertEqual(b''.join(response.streaming_content), PDF_CONTENT[-20:])
+
+    def test_async_range(self):
+        async def read(response):
+            return b''.join([chunk async for chunk in response.streaming_content])
+
+        response = self.get({'Range': 'bytes=100-'}, asynchronous=True)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(async_to_sync(read)(response), PDF_CONTENT[100:])
+
+    def test_unsatisfiable_range(self):
+        response = self.get({'Range': f'bytes={len(PDF_CONTENT)}-'})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(PDF_CONTENT)}')
+
+    def test_if_range_with_another_etag_sends_whole_file(self):
+        response = self.get({'Range': 'bytes=5-14', 'If-Range': '"v0"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), PDF_CONTENT)
+        response.close()
+        self.assertEqual(self.get({'Range': 'bytes=5-14', 'If-Range': '"v1"'}).status_code, 206)
+
+    @override_settings(SENDFILE_BACKEND='xaccel', SENDFILE_URL_PREFIX='/protected-media/')
+    def test_x_accel_redirect(self):
+        response = self.get({'Range': 'bytes=5-14'})
+        # nginx serves the range itself
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/signed.pdf')
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], '"v1"')
+
+    @override_settings(SENDFILE_BACKEND='xsendfile')
+    def test_x_sendfile(self):
+        response = self.get()
+        self.assertEqual(response['X-Sendfile'], self.field_file.path)
+        self.assertEqual(response.content, b'')
+        self.assertIn('attachment; filename="signed.pdf"', response['Content-Disposition'])
+
+
+REPLICA = 'test_replica'
+
+
+class ReplicaRoutingTests(TestCase):
+    """
+    Routing against a second SQLite database standing in for a replica. It
+    holds different data from the primary, so results show where a read went.
+    """
+    # The replica is registered in setUpClass, which '__all__' then includes
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.replica_dir = tempfile.TemporaryDirectory()
+        connections.settings[REPLICA] = connections.configure_settings({
+            'default': connections.settings['default'],
+            REPLICA: {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(cls.replica_dir.name, 'replica.sqlite3'),
+            },
+        })[REPLICA]
+        with connections[REPLICA].schema_editor() as editor:
+            for model in (Users, Document, UserStats, UserKey, Signature):
+                editor.create_model(model)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections[REPLICA].close()
+        del connections[REPLICA]
+        del connections.settings[REPLICA]
+        cls.replica_dir.cleanup()
+
+    def setUp(self):
+        routers._down_until.clear()
+        self.user = make_user('bob')
+        Users.objects.using(REPLICA).create(pk=self.user.pk, username='bob', email='bob@example.com', contact=1)
+        self.document = Document.objects.create(pk=7, user=self.user, title='on primary', file='a.pdf')
+        Document(pk=7, user_id=self.user.pk, title='on replica', file='a.pdf').save(using=REPLICA)
+
+    def read_title(self):
+        return Document.objects.get(pk=7).title
+
+    def in_replica_view(self, func):
+        return routers.replica_reads(lambda request: func())(RequestFactory().get('/'))
+
+    @override_settings(DATABASE_REPLICAS=[REPLICA])
+    def test_reads_in_replica_views_go_to_replica(self):
+        self.assertEqual(self.in_replica_view(self.read_title), 'on replica')
+        self.assertEqual(self.read_title(), 'on primary')
+
+    @override_settings(DATABASE_REPLICAS=[REPLICA])
+    def test_reads_after_a_write_stay_on_primary(self):
+        def write_then_read():
+            Document.objects.filter(pk=7).update(title='written')
+            return self.read_title()
+        self.assertEqual(self.in_replica_view(write_then_read), 'written')
+
+    @override_settings(DATABASE_REPLICAS=[REPLICA])
+    def test_write_pins_client_to_primary(self):
+        factory = RequestFactory()
+
+        @routers.replica_reads
+        def view(request):
+            if request.method == 'POST':
+                Document.objects.filter(pk=7).update(title='written')
+            return HttpResponse(self.read_title())
+
+        middleware = ReplicaPinMiddleware(view)
+        response = middleware(factory.post('/'))
+        self.assertIn(routers.PIN_COOKIE, response.cookies)
+        self.assertEqual(response.cookies[routers.PIN_COOKIE]['max-age'], 10)
+
+        pinned = factory.get('/')
+        pinned.COOKIES[routers.PIN_COOKIE] = '1'
+        self.assertEqual(middleware(pinned).content, b'written')
+        response = middleware(factory.get('/'))
+        self.assertEqual(response.content, b'on replica')
+        self.assertNotIn(routers.PIN_COOKIE, response.cookies)
+
+    def cache_timeouts(self, func):
+        """
+        Call ``func`` and return the timeouts it cached values for.
+        """
+        with mock.patch.object(cache, 'set', wraps=cache.set) as cache_set:
+            func()
+        return [call.args[2] for call in cache_set.call_args_list]
+
+    @override_settings(DATABASE_REPLICAS=[REPLICA], REPLICA_PIN_SECONDS=10, FRAGMENT_CACHE_TIMEOUT=600)
+    def test_values_read_from_replica_are_cached_briefly(self):
+        cache.clear()
+        # A lagging replica's answer must not outlive its lag in the cache
+        timeouts = self.cache_timeouts(
+            lambda: self.assertEqual(self.in_replica_view(lambda: fragments.cached('title', [7], self.read_title)), 'on replica')
+        )
+        self.assertEqual(timeouts, [10])
+        timeouts = self.cache_timeouts(
+            lambda: self.assertEqual(fragments.cached('title', [8], self.read_title), 'on primary')
+        )
+        self.assertEqual(timeouts, [600])
+
+    @override_settings(DATABASE_REPLICAS=[REPLICA], REPLICA_PIN_SECONDS=10)
+    def test_uncached_dashboard_reads_from_replica(self):
+        cache.clear()
+        UserStats(user_id=self.user.pk, documents=1).save(using=REPLICA)
+        UserStats.objects.create(user=self.user, documents=1)
+        request = RequestFactory().get(reverse('dashboard'))
+        request.user = self.user
+        with recording_queries() as recorder:
+            timeouts = self.cache_timeouts(lambda: self.assertContains(views.dashboard(request), 'on replica'))
+        # The stats, the page of documents and the profile
+        self.assertEqual(recorder.count_for(REPLICA), 4)
+        self.assertEqual(recorder.count_for('default'), 0)
+        self.assertTrue(timeouts)
+        self.assertTrue(all(timeout <= 10 for timeout in timeouts))
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_without_replicas_reads_go_to_primary(self):
+        self.assertEqual(self.in_replica_view(self.read_title), 'on primary')
+
+    @override_settings(DATABASE_REPLICAS=[REPLICA])
+    def test_unreachable_replica_falls_back_to_primary(self):
+        with mock.patch.object(connections[REPLICA], 'ensure_connection', side_effect=OperationalError):
+            self.assertEqual(self.in_replica_view(self.read_title), 'on primary')
+        # Not tried again until REPLICA_RETRY_SECONDS have passed
+        self.assertEqual(self.in_replica_view(self.read_title), 'on primary')
+
+
+@tag('slow')
+class SQLiteConcurrencyTests(SimpleTestCase):
+    """
+    A reduced stress_sqlite run: writers in separate processes, each reading
+    then writing in its transactions as signing does.
+    """
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.path = os.path.join(cls.tmp.name, 'stress.sqlite3')
+        # Registered up front so that '__all__' lets the test connect to it
+        stress_sqlite._connect(cls.path, settings.SQLITE_OPTIONS)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections[stress_sqlite.ALIAS].close()
+        del connections[stress_sqlite.ALIAS]
+        del connections.settings[stress_sqlite.ALIAS]
+        cls.tmp.cleanup()
+
+    def test_concurrent_writers_are_not_locked_out(self):
+        committed, locked, _, value, _ = stress_sqlite.run(
+            self.path, settings.SQLITE_OPTIONS, writers=4, transactions=25, hold=0.002,
+        )
+        self.assertEqual(locked, 0)
+        self.assertEqual(committed, 100)
+        self.assertEqual(value, committed)
+
+
+@tag('slow')
+class SigningMemoryTests(SimpleTestCase):
+    def test_signing_a_large_scan_stays_within_memory_budget(self):
+        # A 100 MB document against the default 64 MB budget: holding the
+        # file in memory, rather than appending to a copy, would fail
+        call_command('check_signing_memory', pages=2500, image_kb=40, stdout=StringIO())
+
+
+@tag('slow')
+class StartupImportTests(SimpleTestCase):
+    def test_signing_libraries_are_not_imported_at_startup(self):
+        self.assertEqual(check_import_time.eager_imports(check_import_time.measure_imports()), [])
+
+
+def spin_in_pool_task(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class SlowRequestProfileTests(SimpleTestCase):
+    """
+    Profiles of slow requests sample the pool threads doing their work, not
+    just the view's thread waiting for it.
+    """
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.profile_dir = tmp.name
+        self.enterContext(override_settings(
+            SIGNING_PROFILE_DIR=self.profile_dir, SIGNING_SLOW_THRESHOLD=0, SIGNING_PROFILE_INTERVAL=0.001,
+        ))
+
+    def profile(self):
+        (name,) = os.listdir(self.profile_dir)
+        with open(os.path.join(self.profile_dir, name)) as f:
+            return f.read()
+
+    def test_cpu_pool_work_is_sampled(self):
+        @timed_view('profiled')
+        def view(request):
+            run_cpu(spin_in_pool_task, 0.1)
+            return HttpResponse()
+
+        with self.assertLogs('mainapp.timing', 'WARNING'):
+            view(RequestFactory().get('/'))
+        self.assertIn('spin_in_pool_task', self.profile())
+
+    def test_async_view_blocking_work_is_sampled(self):
+        @timed_view('profiled')
+        async def view(request):
+            await run_blocking(spin_in_pool_task, 0.1)
+            return HttpResponse()
+
+        with self.assertLogs('mainapp.timing', 'WARNING'):
+            async_to_sync(view)(RequestFactory().get('/'))
+        self.assertIn('spin_in_pool_task', self.profile())
+
+
+@override_settings(REQUEST_BODY_MAX_BYTES=100, CHUNKED_UPLOAD_MAX_BYTES=1000)
+class RequestBodyLimitTests(SimpleTestCase):
+    def call(self, path, chunks, content_length=None):
+        """
+        Send a request with a body made of ``chunks`` through RequestBodyLimit
+        to an app that reads the whole body. Returns (status, bytes the app
+        received, whether the app saw the client disconnect).
+        """
+        headers = [] if content_length is None else [(b'content-length', str(content_length).encode())]
+        scope = {'type': 'http', 'method': 'POST', 'path': path, 'headers': headers}
+        messages = [
+            {'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+            for i, chunk in enumerate(chunks)
+        ]
+        received = []
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        async def app(scope, receive, send):
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    received.append(None)
+                    return
+                received.append(message['body'])
+                if not message.get('more_body'):
+                    break
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        async_to_sync(RequestBodyLimit(app))(scope, receive, send)
+        body = b''.join(chunk for chunk in received if chunk is not None)
+        return sent[0]['status'], len(body), None in received
+
+    def test_declared_length_over_limit_is_refused_unread(self):
+        self.assertEqual(self.call('/document/verify/', [b'x' * 101], content_length=101), (413, 0, False))
+
+    def test_streamed_body_is_cut_off_at_limit(self):
+        status, received, disconnected = self.call('/document/verify/', [b'x' * 60] * 5)
+        self.assertEqual(status, 413)
+        self.assertLessEqual(received, 100)
+        self.assertTrue(disconnected)
+
+    def test_body_within_limit_passes(self):
+        self.assertEqual(self.call('/document/verify/', [b'x' * 50] * 2, content_length=100), (200, 100, False))
+
+    def test_resumable_uploads_have_their_own_limit(self):
+        path = reverse('chunked_upload_create')
+        self.assertEqual(self.call(path, [b'x' * 500], content_length=500), (200, 500, False))
+        self.assertEqual(self.call(path, [b'x' * 1001], content_length=1001)[0], 413)
@@ -0,0 +1,283 @@
+"""
+Stage-level timing for the signing and verification pipeline.
+
+Wrap a stage with ``stage('name')`` (as a context manager or decorator).
+Each measurement is added to a per-process histogram and passed to any
+hooks registered with ``register_hook``. Views decorated with
+``timed_view`` also log a per-request breakdown and, when
+SIGNING_PROFILE_DIR is set, sample the stacks of the threads doing their
+work and keep the profile of requests slower than SIGNING_SLOW_THRESHOLD.
+"""
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+
+logger = logging.getLogger('mainapp.timing')
+
+# Upper bounds in seconds, Prometheus style; the last bucket is +Inf.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """
+    Bucketed histogram of durations in seconds. Counts are per bucket,
+    not cumulative.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'buckets': self.buckets,
+                'counts': list(self.counts),
+                'sum': self.sum,
+                'count': self.count,
+            }
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+_hooks = []
+_request_stages = ContextVar('request_stages', default=None)
+_request_sampler = ContextVar('request_sampler', default=None)
+
+
+def register_hook(hook):
+    """
+    Call ``hook(name, seconds)`` for every stage measurement.
+    """
+    if hook not in _hooks:
+        _hooks.append(hook)
+    return hook
+
+
+def unregister_hook(hook):
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+def get_histogram(name):
+    histogram = _histograms.get(name)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(name, Histogram())
+    return histogram
+
+
+def histograms():
+    """
+    Snapshot of every stage histogram recorded by this process.
+    """
+    return {name: histogram.snapshot() for name, histogram in list(_histograms.items())}
+
+
+def reset():
+    with _histograms_lock:
+        _histograms.clear()
+
+
+def observe(name, seconds):
+    get_histogram(name).observe(seconds)
+    stages = _request_stages.get()
+    if stages is not None:
+        stages.append((name, seconds))
+    for hook in _hooks:
+        try:
+            hook(name, seconds)
+        except Exception:
+            logger.exception('Timing hook %r failed', hook)
+
+
+class stage:
+    """
+    Time a block or a function and record it under ``name``.
+
+        with stage('pdf_write'):
+            ...
+
+        @stage('hash')
+        def calculate_hash(...):
+    """
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.perf_counter() - self.start)
+        return False
+
+    def __call__(self, func):
+        name = self.name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class StackSampler(threading.Thread):
+    """
+    Sample the stacks of a set of threads at a fixed interval and count the
+    collapsed stacks, in the folded format flame graph tools read.
+    """
+
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = Counter()
+        self._thread_ids = Counter()
+        self._threads_lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def add_thread(self, thread_id):
+        with self._threads_lock:
+            self._thread_ids[thread_id] += 1
+
+    def remove_thread(self, thread_id):
+        with self._threads_lock:
+            self._thread_ids[thread_id] -= 1
+            if self._thread_ids[thread_id] <= 0:
+                del self._thread_ids[thread_id]
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            with self._threads_lock:
+                thread_ids = list(self._thread_ids)
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                if stack:
+                    self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, 'w') as out:
+            for collapsed, count in self.samples.most_common():
+                out.write(f'{collapsed} {count}\n')
+
+
+@contextmanager
+def sampled_thread():
+    """
+    Sample the current thread's stack, while in the block, for the profile
+    of the request being timed, if any. The offload pools run the work they
+    are handed in this, so the profile shows it rather than the view's
+    thread waiting for it.
+    """
+    sampler = _request_sampler.get()
+    if sampler is None:
+        yield
+        return
+    thread_id = threading.get_ident()
+    sampler.add_thread(thread_id)
+    try:
+        yield
+    finally:
+        sampler.remove_thread(thread_id)
+
+
+@contextmanager
+def _timed_request(name, sample_thread=None):
+    threshold = getattr(settings, 'SIGNING_SLOW_THRESHOLD', 2.0)
+    profile_dir = getattr(settings, 'SIGNING_PROFILE_DIR', None)
+
+    sampler = sampler_token = None
+    if profile_dir:
+        sampler = StackSampler(getattr(settings, 'SIGNING_PROFILE_INTERVAL', 0.005))
+        if sample_thread is not None:
+            sampler.add_thread(sample_thread)
+        sampler_token = _request_sampler.set(sampler)
+        sampler.start()
+
+    stages = []
+    token = _request_stages.set(stages)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        total = time.perf_counter() - start
+        _request_stages.reset(token)
+        observe(name, total)
+        if sampler is not None:
+            sampler.stop()
+            _request_sampler.reset(sampler_token)
+
+        breakdown = ' '.join(f'{stage_name}={seconds * 1000:.1f}ms' for stage_name, seconds in stages)
+        slow = total >= threshold
+        logger.log(
+            logging.WARNING if slow else logging.INFO,
+            '%s total=%.1fms %s', name, total * 1000, breakdown,
+            extra={'view': name, 'duration_ms': round(total * 1000, 1), 'stages': stages},
+        )
+        if slow and sampler is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+            path = os.path.join(profile_dir, f'{name}-{int(time.time())}-{os.getpid()}.folded')
+            sampler.write(path)
+            logger.warning('Wrote profile of slow %s request to %s', name, path)
+
+
+def timed_view(name):
+    """
+    Collect the stages run by a view and log their breakdown. Requests
+    slower than SIGNING_SLOW_THRESHOLD are logged as warnings and, with
+    SIGNING_PROFILE_DIR set, have their sampled profile written there.
+
+    The profile samples the view's thread (for sync views) and the pool
+    threads running work it hands to run_blocking() or run_cpu(), so async
+    views and offloaded stamping and signing are profiled too.
+    """
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                with _timed_request(name):
+                    return await view(request, *args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            with _timed_request(name, threading.get_ident()):
+                return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,247 @@
+"""
+Early validation of PDF uploads.
+
+PDFUploadHandler sits in front of Django's default upload handlers and
+inspects each chunk as it arrives. A file whose header is not a PDF is
+skipped before it reaches disk, and an upload over the size limit stops
+the request body from being read any further. Reasons are collected in
+``request.upload_errors`` for the view to show. Each file is also hashed
+as it streams past, into ``request.upload_hashes`` by field name, so the
+view and the storage don't read it again to hash it.
+
+Under ASGI, though, Django receives a request's whole body (spooling it to
+disk past FILE_UPLOAD_MAX_MEMORY_SIZE) before any upload handler runs. So
+core.asgi wraps the application in RequestBodyLimit, which refuses bodies
+over the limit before Django reads them.
+"""
+import functools
+import hashlib
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile, StopUpload
+from django.db.models import Q
+from django.template.defaultfilters import filesizeformat
+from django.urls import reverse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+
+from .offload import resolve_user, run_blocking
+
+# The PDF header may be preceded by up to 1 KB of junk, and readers look
+# for the trailer within the last 1 KB of the file.
+HEADER_WINDOW = 1024
+TRAILER_WINDOW = 1024
+# Allowance for form fields and multipart boundaries around the file
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+def is_pdf_header(head):
+    return b'%PDF-' in head[:HEADER_WINDOW]
+
+
+def is_pdf_trailer(tail):
+    tail = tail[-TRAILER_WINDOW:]
+    return b'%%EOF' in tail and b'startxref' in tail
+
+
+def upload_limit(request, default=None):
+    """
+    Maximum upload size in bytes for this request: the limit of the user's
+    own unexpired API token when one is sent as a bearer token, else the
+    user's, else ``default`` (PDF_UPLOAD_MAX_BYTES unless given).
+    """
+    from .models import ApiToken
+
+    if default is None:
+        default = settings.PDF_UPLOAD_MAX_BYTES
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return default
+
+    auth = request.headers.get('Authorization', '')
+    if auth.startswith('Bearer '):
+        token_limit = ApiToken.objects.filter(
+            Q(expires_at__isnull=True) | Q(expires_at__gt=timezone.now()),
+            token=auth[len('Bearer '):], user=user,
+        ).values_list('max_upload_bytes', flat=True).first()
+        if token_limit:
+            return token_limit
+
+    return user.max_upload_bytes or default
+
+
+def check_pdf_file(uploaded_file, max_bytes):
+    """
+    Return an error message if a complete uploaded file is not a PDF or is
+    too large, else None. Reads only the first and last kilobyte.
+    """
+    if max_bytes and uploaded_file.size > max_bytes:
+        return f'File is too large ({filesizeformat(uploaded_file.size)}); the limit is {filesizeformat(max_bytes)}.'
+    uploaded_file.seek(0)
+    head = uploaded_file.read(HEADER_WINDOW)
+    uploaded_file.seek(max(uploaded_file.size - TRAILER_WINDOW, 0))
+    tail = uploaded_file.read(TRAILER_WINDOW)
+    uploaded_file.seek(0)
+    if not is_pdf_header(head):
+        return 'File is not a PDF document.'
+    if not is_pdf_trailer(tail):
+        return 'PDF document is truncated or corrupt.'
+    return None
+
+
+class PDFUploadHandler(FileUploadHandler):
+    """
+    Pass-through upload handler that rejects non-PDF and oversized files
+    while they are still streaming in.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.max_bytes = upload_limit(request)
+        self.refuse_body = False
+        request.upload_limit = self.max_bytes
+        request.upload_errors = []
+        request.upload_hashes = {}
+
+    def _reject(self, message):
+        self.request.upload_errors.append(message)
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        # The whole body is already too big: refuse it without reading it
+        self.refuse_body = bool(
+            self.max_bytes and content_length and content_length > self.max_bytes + MULTIPART_OVERHEAD
+        )
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.head = b''
+        self.tail = b''
+        self.sha256 = hashlib.sha256()
+        if self.refuse_body:
+            self._reject(f'File is too large; the limit is {filesizeformat(self.max_bytes)}.')
+            raise StopUpload(connection_reset=True)
+
+    def receive_data_chunk(self, raw_data, start):
+        received = start + len(raw_data)
+        if self.max_bytes and received > self.max_bytes:
+            self._reject(f'File is too large; the limit is {filesizeformat(self.max_bytes)}.')
+            raise StopUpload(connection_reset=True)
+
+        if len(self.head) < HEADER_WINDOW:
+            self.head += raw_data[:HEADER_WINDOW - len(self.head)]
+            if len(self.head) >= HEADER_WINDOW and not is_pdf_header(self.head):
+                self._reject(f'{self.file_name} is not a PDF document.')
+                raise SkipFile()
+        self.tail = (self.tail + raw_data[-TRAILER_WINDOW:])[-TRAILER_WINDOW:]
+        self.sha256.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        if not is_pdf_header(self.head):
+            self._reject(f'{self.file_name} is not a PDF document.')
+        elif not is_pdf_trailer(self.tail):
+            self._reject(f'{self.file_name} is truncated or corrupt.')
+        self.request.upload_hashes[self.field_name] = self.sha256.hexdigest()
+        # Let the next handler build the file object
+        return None
+
+
+def _parse_with_handler(request):
+    request.upload_handlers.insert(0, PDFUploadHandler(request))
+    if request.method == 'POST':
+        # Parses the multipart body, FILES included
+        request.POST
+
+
+def validate_pdf_uploads(view):
+    """
+    Install PDFUploadHandler for a view. Handlers have to be in place before
+    CSRF checking reads the body, so CSRF protection moves inside.
+
+    For async views the handler is built (it looks up the caller's limit)
+    and the body parsed on the blocking-work pool, not the event loop.
+    """
+    protected = csrf_protect(view)
+
+    if iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            await resolve_user(request)
+            await run_blocking(_parse_with_handler, request)
+            return await protected(request, *args, **kwargs)
+        return csrf_exempt(async_wrapper)
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        request.upload_handlers.insert(0, PDFUploadHandler(request))
+        return protected(request, *args, **kwargs)
+    return csrf_exempt(wrapper)
+
+
+def request_body_limit(path):
+    """
+    Largest request body accepted for ``path``, in bytes.
+    """
+    if path.startswith(reverse('chunked_upload_create')):
+        return settings.CHUNKED_UPLOAD_MAX_BYTES
+    return settings.REQUEST_BODY_MAX_BYTES
+
+
+class RequestBodyLimit:
+    """
+    ASGI middleware answering requests whose body is over
+    request_body_limit() with 413 Content Too Large. Bodies that declare a
+    larger Content-Length are refused without being read; others are
+    counted as they arrive and cut off once they pass the limit, which
+    Django sees as the client disconnecting.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        limit = request_body_limit(scope['path'])
+        headers = dict(scope.get('headers', ()))
+        length = headers.get(b'content-length', b'')
+        if length.isdigit() and int(length) > limit:
+            return await self.refuse(send, limit)
+
+        received = 0
+        exceeded = started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    exceeded = True
+                    return {'type': 'http.disconnect'}
+            return message
+
+        async def tracked_send(message):
+            nonlocal started
+            started = started or message['type'] == 'http.response.start'
+            await send(message)
+
+        await self.app(scope, limited_receive, tracked_send)
+        if exceeded and not started:
+            await self.refuse(send, limit)
+
+    @staticmethod
+    async def refuse(send, limit):
+        body = f'Request body is too large; the limit is {filesizeformat(limit)}.'.encode()
+        await send({
+            'type': 'http.response.start',
+            'status': 413,
+            'headers': [
+                (b'content-type', b'text/plain; charset=utf-8'),
+                (b'content-length', str(len(body)).encode()),
+                (b'connection', b'close'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
@@ -9,10 +9,14 @@ urlpatterns = [
     path('signature/upload/', views.upload_signature, name='upload_signature'),
     path('keys/generate/', views.generate_keys, name='generate_keys'),
     path('document/upload/', views.upload_document, name='upload_document'),
+    path('document/uploads/', views.chunked_upload_create, name='chunked_upload_create'),
+    path('document/uploads/<uuid:upload_id>/', views.chunked_upload_detail, name='chunked_upload_detail'),
     path('document/<int:document_id>/sign/', views.sign_document, name='sign_document'),
+    path('document/<int:document_id>/download/', views.download_document, name='download_document'),
     path('document/verify/', views.verify_document, name='verify_document'),
     path('api_tokens/', views.api_tokens_view, name='api_token'),
     path('api_tokens/generate/', views.add_api_token_view, name='generate_token_view'),
+    path('metrics', views.metrics_view, name='metrics'),
 
     path('logout/', auth_views.LogoutView.as_view(next_page='login'), name='logout'),
 ]
\ No newline at end of file
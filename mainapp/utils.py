@@ -1,64 +1,396 @@
 import hashlib
 import io
 import os
+import shutil
 import base64
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from pypdf import PdfReader, PdfWriter
+import functools
+import importlib
+import math
+from collections import namedtuple
 from django.conf import settings
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.fernet import Fernet
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from .timing import stage
 
+# Pillow, ReportLab, pypdf and cryptography are imported by the functions
+# that use them, so that loading this module (as every view does) stays
+# cheap and only signing and verification pay for them.
+LAZY_MODULES = (
+    'PIL.Image',
+    'reportlab.pdfgen.canvas',
+    'reportlab.lib.utils',
+    'pypdf',
+    'cryptography.fernet',
+    'cryptography.hazmat.primitives.asymmetric.rsa',
+    'mainapp.pdfupdate',
+)
+
+def import_lazy_modules():
+    """
+    Import everything this module otherwise loads on first use, e.g. in a
+    server's master process so its forked workers share the result.
+    """
+    for name in LAZY_MODULES:
+        importlib.import_module(name)
+
+@stage('hash')
 def calculate_hash(file_path):
     """
     Calculate the SHA256 hash of a file.
     """
-    sha256_hash = hashlib.sha256()
     with open(file_path, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
+        return hash_chunks(iter(lambda: f.read(4096), b""))
+
+def hash_chunks(chunks):
+    """
+    Calculate the SHA256 hash of an iterable of byte chunks, e.g. an
+    uploaded file's chunks().
+    """
+    sha256_hash = hashlib.sha256()
+    for byte_block in chunks:
+        sha256_hash.update(byte_block)
     return sha256_hash.hexdigest()
 
-def sign_pdf(original_pdf_path, signature_image_path, output_path):
+# Linux ioctl that clones a file's extents (copy-on-write) on btrfs, XFS, etc.
+FICLONE = 0x40049409
+
+def clone_file(src, dst):
+    """
+    Give dst the same content as src without copying bytes when the
+    filesystem allows it: a hard link, then a reflink, then a plain copy.
+    dst must not exist. Returns the method used.
+    """
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except OSError:
+        pass
+
+    try:
+        import fcntl
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return 'reflink'
+    except (ImportError, OSError):
+        if os.path.exists(dst):
+            os.remove(dst)
+
+    shutil.copy2(src, dst)
+    return 'copy'
+
+class StagedFile(File):
+    """
+    A finished file on local disk, handed to a storage backend for saving.
+
+    Exposing temporary_file_path() lets FileSystemStorage move the file into
+    place with a rename instead of copying its bytes again. Pass ``sha256``
+    when the content hash is already known so storage needn't recompute it.
+    """
+    def __init__(self, path, sha256=None):
+        super().__init__(None, name=path)
+        self.sha256 = sha256
+
+    def temporary_file_path(self):
+        return self.name
+
+    @property
+    def size(self):
+        return os.path.getsize(self.name)
+
+    def open(self, mode='rb'):
+        self.file = open(self.name, mode)
+        return self
+
+    def chunks(self, chunk_size=None):
+        # Other storage backends stream the content instead of moving it
+        if self.file is None or self.closed:
+            self.open()
+        try:
+            yield from super().chunks(chunk_size)
+        finally:
+            self.close()
+
+# Size the signature is drawn at on the page, in points (1/72 inch)
+SIGNATURE_WIDTH = 150
+SIGNATURE_HEIGHT = 50
+
+def normalize_signature_image(uploaded_image):
+    """
+    Prepare an uploaded signature for embedding: undo camera rotation, crop
+    to the ink, downsample to the size it is drawn at (SIGNATURE_RENDER_DPI)
+    and re-encode as an optimized PNG, keeping any transparency.
+    Returns a ContentFile named after the upload.
+    """
+    from PIL import Image, ImageOps
+
+    dpi = settings.SIGNATURE_RENDER_DPI
+    max_size = (SIGNATURE_WIDTH * dpi // 72, SIGNATURE_HEIGHT * dpi // 72)
+
+    uploaded_image.seek(0)
+    with Image.open(uploaded_image) as img:
+        img = ImageOps.exif_transpose(img)
+        has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+        if has_alpha:
+            # Screenshots often have an alpha channel without a single
+            # transparent pixel; only a see-through background marks the ink
+            img = img.convert('RGBA')
+            has_alpha = img.getchannel('A').getextrema()[0] < 255
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+
+        # Ink is whatever is opaque, or darker than the paper
+        if has_alpha:
+            ink = img.getchannel('A')
+        else:
+            ink = ImageOps.invert(img.convert('L')).point(lambda v: 255 if v > 32 else 0)
+        bbox = ink.getbbox()
+        if bbox:
+            pad = max(img.size) // 100
+            img = img.crop((
+                max(bbox[0] - pad, 0), max(bbox[1] - pad, 0),
+                min(bbox[2] + pad, img.width), min(bbox[3] + pad, img.height),
+            ))
+
+        img.thumbnail(max_size, Image.Resampling.LANCZOS)
+        if not has_alpha:
+            # Signatures are a handful of colours; a palette PNG is far smaller
+            img = img.quantize(colors=64)
+
+        out = io.BytesIO()
+        img.save(out, format='PNG', optimize=True)
+
+    stem = os.path.splitext(os.path.basename(uploaded_image.name))[0]
+    return ContentFile(out.getvalue(), name=f'{stem}.png')
+
+def signature_reader(image_path):
+    """
+    Decoded signature image, reused across signings of the same file.
+    """
+    return _signature_reader(image_path, os.path.getmtime(image_path))
+
+@functools.lru_cache(maxsize=64)
+def _signature_reader(image_path, mtime):
+    from reportlab.lib.utils import ImageReader
+    return ImageReader(image_path)
+
+def _resources_to_extend(update, page):
+    """
+    The page's /XObject resource dictionary, created if need be, with
+    whichever object holds it marked as modified.
+    """
+    from pypdf.generic import DictionaryObject, NameObject
+
+    resources = page.raw_get('/Resources') if '/Resources' in page else None
+    if resources is None:
+        resources = page[NameObject('/Resources')] = DictionaryObject()
+    resources = resources.get_object()
+
+    xobjects = resources.raw_get('/XObject') if '/XObject' in resources else None
+    if xobjects is None:
+        xobjects = resources[NameObject('/XObject')] = DictionaryObject()
+    xobjects = xobjects.get_object()
+    # Indirect dictionaries are written on their own; direct ones with the page
+    update.modified(xobjects) or update.modified(resources)
+    return xobjects
+
+def _add_stream(update, data):
+    from pypdf.generic import DecodedStreamObject
+    stream = DecodedStreamObject()
+    stream.set_data(data)
+    return update.add_object(stream)
+
+@stage('stamp_pages')
+def stamp_pages(update, overlay_page, page_indices):
+    """
+    Draw ``overlay_page`` over each page in ``page_indices`` of the
+    IncrementalUpdate ``update``.
+
+    The overlay is embedded once as a form XObject and every page only gains
+    a reference to it, so the output grows by a few bytes per page instead
+    of by a copy of the overlay's content (as PageObject.merge_page does).
+    The page's own content is wrapped in q/Q so its graphics state can't
+    shift the stamp.
+    """
+    from pypdf.generic import ArrayObject, DecodedStreamObject, NameObject, RectangleObject
+
+    pages = [update.pages[i] for i in page_indices]
+    xobjects = [_resources_to_extend(update, page) for page in pages]
+
+    # A resource name none of the stamped pages already uses
+    taken = set()
+    for names in xobjects:
+        taken.update(names.keys())
+    name, n = '/DigiSig', 0
+    while name in taken:
+        n += 1
+        name = f'/DigiSig{n}'
+
+    form = DecodedStreamObject()
+    form.set_data(overlay_page.get_contents().get_data())
+    form.update({
+        NameObject('/Type'): NameObject('/XObject'),
+        NameObject('/Subtype'): NameObject('/Form'),
+        NameObject('/BBox'): RectangleObject(overlay_page.mediabox),
+        NameObject('/Resources'): update.import_object(overlay_page.raw_get('/Resources')),
+    })
+    form_ref = update.add_object(form.flate_encode())
+
+    # The wrapper streams are shared too: one per distinct page origin
+    save_ref = _add_stream(update, b'q\n')
+    draw_refs = {}
+    for page, names in zip(pages, xobjects):
+        names[NameObject(name)] = form_ref
+
+        origin = (page.mediabox.left, page.mediabox.bottom)
+        if origin not in draw_refs:
+            offset = f'1 0 0 1 {origin[0]} {origin[1]} cm ' if any(origin) else ''
+            draw_refs[origin] = _add_stream(update, f'Q q {offset}{name} Do Q\n'.encode())
+
+        contents = page.raw_get('/Contents') if '/Contents' in page else None
+        if contents is None:
+            existing = []
+        elif update.is_array(contents):
+            existing = list(contents.get_object())
+        else:
+            existing = [contents]
+        page[NameObject('/Contents')] = ArrayObject([save_ref, *existing, draw_refs[origin]])
+        if not update.modified(page):
+            raise ValueError('PDF page objects must be indirect to be signed.')
+
+Placement = namedtuple('Placement', ['page', 'rect', 'asset'])
+Placement.__doc__ = """
+Something to draw on a page: ``page`` is a 0-based index (negative counts
+from the end, None means every page), ``rect`` is (x, y, width, height) in
+points from the page's lower-left corner and ``asset`` is one of
+PLACEMENT_ASSETS.
+"""
+
+PLACEMENT_ASSETS = ('signature', 'date')
+MAX_PLACEMENTS = 100
+# Bottom right-ish of the last page, where signatures have always gone
+DEFAULT_PLACEMENT = Placement(-1, (400, 50, SIGNATURE_WIDTH, SIGNATURE_HEIGHT), 'signature')
+
+def parse_placements(data):
+    """
+    Build Placements from decoded JSON: a list of objects with "x", "y" and
+    optional "page" (default -1), "width", "height" (default the signature
+    size) and "asset" (default "signature"). Raises ValueError.
+    """
+    if not isinstance(data, list) or not data:
+        raise ValueError('Placements must be a non-empty list.')
+    if len(data) > MAX_PLACEMENTS:
+        raise ValueError(f'At most {MAX_PLACEMENTS} placements are allowed.')
+
+    placements = []
+    for item in data:
+        if not isinstance(item, dict):
+            raise ValueError('Each placement must be an object.')
+        asset = item.get('asset', 'signature')
+        if asset not in PLACEMENT_ASSETS:
+            raise ValueError(f'Unknown placement asset: {asset}.')
+        try:
+            page = item.get('page', -1)
+            page = None if page is None else int(page)
+            rect = (
+                float(item['x']), float(item['y']),
+                float(item.get('width', SIGNATURE_WIDTH)), float(item.get('height', SIGNATURE_HEIGHT)),
+            )
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Placements need a numeric x and y.')
+        if not all(map(math.isfinite, rect)) or rect[2] <= 0 or rect[3] <= 0:
+            raise ValueError('Placement sizes must be positive numbers.')
+        placements.append(Placement(page, rect, asset))
+    return placements
+
+def _draw_asset(can, rect, asset, signature_image_path, today):
+    x, y, width, height = rect
+    if asset == 'signature':
+        can.drawImage(signature_reader(signature_image_path), x, y, width=width, height=height, mask='auto', preserveAspectRatio=True)
+    else:
+        font_size = min(height * 0.8, 12)
+        can.setFont('Helvetica', font_size)
+        can.drawString(x, y + (height - font_size) / 2, today)
+
+def sign_pdf(original_pdf_path, signature_image_path, output_path, placements=None, all_pages=False):
     """
-    Overlay signature image on the last page of the PDF.
+    Overlay the signature on the PDF at each of ``placements``; by default
+    at the bottom of the last page, or of every page when ``all_pages`` is
+    set. However many placements there are, the PDF is written once, as an
+    incremental update that leaves the original bytes untouched.
     """
-    # Create the signature overlay
-    packet = io.BytesIO()
-    # Create a new PDF with Reportlab
-    can = canvas.Canvas(packet, pagesize=letter)
-    # Using fixed coordinates for now: x=400, y=50 (bottom right-ish)
-    can.drawImage(signature_image_path, 400, 50, width=150, height=50, mask='auto', preserveAspectRatio=True)
-    can.save()
+    from .pdfupdate import DamagedPDFError, IncrementalUpdate, repair
+
+    if placements is None:
+        placements = [DEFAULT_PLACEMENT._replace(page=None) if all_pages else DEFAULT_PLACEMENT]
+
+    # Open the existing PDF for appending to; only the pages being stamped
+    # are parsed
+    try:
+        update = IncrementalUpdate(original_pdf_path)
+    except DamagedPDFError:
+        with stage('pdf_repair'):
+            repair(original_pdf_path, output_path)
+        update = IncrementalUpdate(output_path)
+    with update:
+        _stamp_placements(update, placements, signature_image_path)
+        with stage('pdf_write'):
+            update.write(output_path)
+
+    return output_path
+
+def _stamp_placements(update, placements, signature_image_path):
+    from pypdf import PdfReader
+    from reportlab.pdfgen import canvas
+
+    num_pages = len(update.pages)
+
+    drawn_on = {}
+    for placement in placements:
+        if placement.page is None:
+            targets = range(num_pages)
+        elif -num_pages <= placement.page < num_pages:
+            targets = [placement.page % num_pages]
+        else:
+            raise ValueError(f'Page {placement.page} is out of range; the document has {num_pages} pages.')
+        for i in targets:
+            drawn_on.setdefault(i, []).append((placement.rect, placement.asset))
+
+    # Pages of the same size with the same things drawn on them share one
+    # overlay page, and so one form XObject
+    groups = {}
+    for i, drawn in drawn_on.items():
+        box = update.pages[i].mediabox
+        groups.setdefault((float(box.width), float(box.height), tuple(drawn)), []).append(i)
+
+    # Create the overlay: one page per group, in a single Reportlab document
+    # so a signature drawn in several places is embedded once
+    with stage('overlay'):
+        packet = io.BytesIO()
+        can = canvas.Canvas(packet)
+        today = timezone.localdate().isoformat()
+        for width, height, drawn in groups:
+            can.setPageSize((width, height))
+            for rect, asset in drawn:
+                _draw_asset(can, rect, asset, signature_image_path, today)
+            can.showPage()
+        can.save()
 
     # Move to the beginning of the StringIO buffer
     packet.seek(0)
-    new_pdf = PdfReader(packet)
-    
-    # Read existing PDF
-    existing_pdf = PdfReader(open(original_pdf_path, "rb"))
-    output = PdfWriter()
-    
-    num_pages = len(existing_pdf.pages)
-    for i in range(num_pages):
-        page = existing_pdf.pages[i]
-        if i == num_pages - 1:
-            # Merge the signature page (overlay) onto the last page
-            page.merge_page(new_pdf.pages[0])
-        output.add_page(page)
-        
-    with open(output_path, "wb") as outputStream:
-        output.write(outputStream)
-        
-    return output_path
+    overlay = PdfReader(packet)
+    for overlay_page, page_indices in zip(overlay.pages, groups.values()):
+        stamp_pages(update, overlay_page, page_indices)
 
 # --- Cryptographic Functions ---
 
+@stage('keygen')
 def generate_key_pair():
     """
     Generates a private and public key pair.
     """
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
     private_key = rsa.generate_private_key(
         public_exponent=65537,
         key_size=2048,
@@ -86,20 +418,27 @@ def encrypt_private_key(private_key_pem):
     """
     Encrypts the private key for storage using Fernet (symmetric encryption).
     """
+    from cryptography.fernet import Fernet
     f = Fernet(FERNET_KEY)
     return f.encrypt(private_key_pem.encode()).decode()
 
+@stage('decrypt_key')
 def decrypt_private_key(encrypted_private_key):
     """
     Decrypts the stored private key.
     """
+    from cryptography.fernet import Fernet
     f = Fernet(FERNET_KEY)
     return f.decrypt(encrypted_private_key.encode()).decode()
 
+@stage('rsa_sign')
 def sign_hash(data_hash, private_key_pem):
     """
     Sign the hash of a document using the private key.
     """
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding
+
     private_key = serialization.load_pem_private_key(
         private_key_pem.encode(),
         password=None
@@ -120,10 +459,14 @@ def sign_hash(data_hash, private_key_pem):
     
     return base64.b64encode(signature).decode('utf-8')
 
+@stage('rsa_verify')
 def verify_signature(data_hash, signature_b64, public_key_pem):
     """
     Verifies the signature of a document hash.
     """
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding
+
     try:
         public_key = serialization.load_pem_public_key(public_key_pem.encode())
         signature = base64.b64decode(signature_b64)
@@ -1,18 +1,33 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.template.loader import render_to_string
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.contrib.auth.forms import AuthenticationForm
-from django.core.files import File
-from django.core.files.base import ContentFile
 from django.conf import settings
+import json
 import os
-import shutil
+import tempfile
 from .forms import *
 from .models import *
 from .models import *
-from .utils import sign_pdf, calculate_hash, generate_key_pair, encrypt_private_key, decrypt_private_key, sign_hash, verify_signature
+from . import metrics
+from .downloads import serve_file
+from .offload import Overloaded, resolve_user, run_blocking, run_cpu
+from .routers import replica_reads
+from .fragments import ALL_DOCUMENTS, cached, cached_fragment, documents_version
+from .auth import user_profile
+from .stats import get_user_stats
+from .storage import delete_on_commit
+from . import chunked
+from .uploads import upload_limit, validate_pdf_uploads
+from .timing import stage, timed_view
+from .utils import StagedFile, sign_pdf, parse_placements, calculate_hash, hash_chunks, clone_file, generate_key_pair, encrypt_private_key, decrypt_private_key, sign_hash, verify_signature
 from django.core.paginator import Paginator
+from django.http import Http404, HttpResponse
+from django.urls import reverse
+from django.utils.http import http_date
+from django.views.decorators.http import require_http_methods, require_safe
 from django.utils import timezone
 
 
@@ -71,13 +86,36 @@ def logout_view(request):
     return redirect('login')
 
 @login_required
+@replica_reads
 def dashboard(request):
-    documents = Document.objects.filter(user=request.user).order_by('-updated_at')
-    try:
-        has_keys = hasattr(request.user, 'key_pair')
-    except:
-        has_keys = False
-    return render(request, 'users/home.html', {'documents': documents, 'has_keys': has_keys})
+    user_id = request.user.pk
+    version = documents_version(user_id)
+    user_stats = cached('dashboard_stats', [user_id, version], lambda: get_user_stats(user_id))
+
+    documents = (
+        Document.objects.filter(user_id=user_id)
+        .order_by('-updated_at')
+        .only('id', 'title', 'created_at', 'signed_file')
+    )
+    paginator = Paginator(documents, 25)
+    # Take the count from the stats rather than counting the documents
+    paginator.count = user_stats.documents
+    page = paginator.get_page(request.GET.get('page'))
+    # The page's queryset is only evaluated when the table isn't cached
+    documents_table = cached_fragment(
+        'dashboard_documents', [user_id, version, page.number],
+        lambda: render_to_string('users/document_table.html', {
+            'documents': page,
+            'page_range': paginator.get_elided_page_range(page.number),
+        }),
+    )
+    profile = user_profile(request)
+    return render(request, 'users/dashboard.html', {
+        'user_stats': user_stats,
+        'documents_table': documents_table,
+        'has_keys': profile['has_keys'],
+        'has_signature': profile['has_signature'],
+    })
 
 @login_required
 def upload_signature(request):
@@ -87,6 +125,7 @@ def upload_signature(request):
             signature = form.save(commit=False)
             signature.user = request.user
             signature.save()
+            metrics.UPLOAD_BYTES.labels(kind='signature').inc(signature.image.size)
             messages.success(request, 'Signature uploaded successfully.')
             return redirect('dashboard')
     else:
@@ -112,26 +151,145 @@ def generate_keys(request):
             public_key=public_pem,
             private_key=encrypted_private
         )
+        metrics.KEYS_GENERATED.inc()
         messages.success(request, 'Cryptographic keys generated successfully.')
         return redirect('dashboard')
     
     return render(request, 'users/generate_keys.html')
 
+def _save_uploaded_document(request):
+    form = DocumentForm(
+        request.POST, request.FILES,
+        upload_errors=request.upload_errors,
+        max_upload_bytes=request.upload_limit,
+    )
+    if not form.is_valid():
+        return form, None
+    document = form.save(commit=False)
+    document.user = request.user
+    uploaded = form.cleaned_data['file']
+    # Hashed by PDFUploadHandler as it arrived; storage reuses it for the blob name
+    uploaded.sha256 = request.upload_hashes.get('file') or hash_chunks(uploaded.chunks())
+    document.original_hash = uploaded.sha256
+    document.save()
+    metrics.UPLOAD_BYTES.labels(kind='document').inc(document.file.size)
+    return form, document
+
 @login_required
-def upload_document(request):
+@validate_pdf_uploads
+async def upload_document(request):
+    # Async so slow uploads don't hold a worker thread; the body has been
+    # received and parsed by the time this runs
     if request.method == 'POST':
-        form = DocumentForm(request.POST, request.FILES)
-        if form.is_valid():
-            document = form.save(commit=False)
-            document.user = request.user
-            document.save()
+        form, document = await run_blocking(_save_uploaded_document, request)
+        if document is not None:
             messages.success(request, 'Document uploaded successfully.')
             return redirect('dashboard') # Should redirect to list eventually
     else:
         form = DocumentForm()
-    return render(request, 'documents/upload.html', {'form': form})
+    return await run_blocking(render, request, 'documents/upload.html', {'form': form})
+
+def _tus_response(status=204, **headers):
+    response = HttpResponse(status=status)
+    response['Tus-Resumable'] = chunked.TUS_VERSION
+    for name, value in headers.items():
+        response[name.replace('_', '-')] = str(value)
+    return response
+
+@login_required
+@require_http_methods(['OPTIONS', 'POST'])
+def chunked_upload_create(request):
+    if request.method == 'OPTIONS':
+        return _tus_response(
+            Tus_Version=chunked.TUS_VERSION,
+            Tus_Extension=chunked.TUS_EXTENSIONS,
+            Tus_Checksum_Algorithm='sha256',
+            Tus_Max_Size=upload_limit(request, settings.CHUNKED_UPLOAD_MAX_BYTES),
+        )
+    
+    try:
+        length = int(request.headers['Upload-Length'])
+        metadata = chunked.parse_metadata(request.headers.get('Upload-Metadata'))
+    except (KeyError, ValueError) as e:
+        return _tus_response(400, Upload_Error=str(e) or 'Upload-Length is required.')
+    
+    limit = upload_limit(request, settings.CHUNKED_UPLOAD_MAX_BYTES)
+    if length <= 0 or (limit and length > limit):
+        return _tus_response(413)
+    
+    filename = os.path.basename(metadata.get('filename') or 'document.pdf')
+    title = metadata.get('title') or filename
+    for field, value in (('filename', filename), ('title', title)):
+        max_length = ChunkedUpload._meta.get_field(field).max_length
+        if len(value) > max_length:
+            return _tus_response(400, Upload_Error=f'The {field} is longer than {max_length} characters.')
+
+    upload = ChunkedUpload.objects.create(
+        user=request.user,
+        title=title,
+        filename=filename,
+        length=length,
+    )
+    return _tus_response(
+        201,
+        Location=reverse('chunked_upload_detail', args=[upload.upload_id]),
+        Upload_Offset=0,
+        Upload_Expires=http_date(chunked.expires_at(upload).timestamp()),
+    )
+
+@login_required
+@require_http_methods(['HEAD', 'PATCH', 'DELETE'])
+def chunked_upload_detail(request, upload_id):
+    upload = get_object_or_404(ChunkedUpload, upload_id=upload_id, user=request.user, document__isnull=True)
+    if chunked.is_expired(upload):
+        chunked.discard(upload)
+        upload.delete()
+        return _tus_response(410)
+    
+    if request.method == 'HEAD':
+        return _tus_response(
+            200, Upload_Offset=upload.offset, Upload_Length=upload.length, Cache_Control='no-store',
+            Upload_Expires=http_date(chunked.expires_at(upload).timestamp()),
+        )
+    
+    if request.method == 'DELETE':
+        chunked.discard(upload)
+        upload.delete()
+        return _tus_response(204)
+    
+    if request.content_type != 'application/offset+octet-stream':
+        return _tus_response(415)
+    try:
+        offset = int(request.headers['Upload-Offset'])
+        length = int(request.headers.get('Content-Length') or 0)
+        checksum = chunked.parse_checksum(request.headers.get('Upload-Checksum'))
+        # Reads the body straight from the socket, bypassing request.body
+        chunked.append_part(upload, request, length, offset, checksum)
+    except (KeyError, ValueError) as e:
+        status = getattr(e, 'status', 400)
+        return _tus_response(status, Upload_Offset=upload.offset, Upload_Error=str(e) or 'Upload-Offset is required.')
+    
+    metrics.UPLOAD_BYTES.labels(kind='chunked').inc(length)
+    headers = {'Upload_Offset': upload.offset}
+    if upload.offset == upload.length:
+        try:
+            document = chunked.complete(upload)
+        except chunked.ChunkError as e:
+            chunked.discard(upload)
+            upload.delete()
+            return _tus_response(e.status, Upload_Error=str(e))
+        upload.document = document
+        upload.save(update_fields=['document', 'updated_at'])
+        headers['Upload_Document'] = document.id
+    else:
+        headers['Upload_Expires'] = http_date(chunked.expires_at(upload).timestamp())
+    return _tus_response(204, **headers)
+
+def _sign_with_key(hash_value, encrypted_private_key):
+    return sign_hash(hash_value, decrypt_private_key(encrypted_private_key))
 
 @login_required
+@timed_view('sign_document')
 def sign_document(request, document_id):
     document = get_object_or_404(Document, id=document_id, user=request.user)
     signature = Signature.objects.filter(user=request.user).first()
@@ -142,95 +300,181 @@ def sign_document(request, document_id):
 
     if request.method == 'POST':
         output_filename = f"signed_{document.file.name.split('/')[-1]}"
-        output_path = os.path.join(settings.MEDIA_ROOT, 'documents/signed', output_filename)
-        
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        # Stage the output next to media so storage can rename it into place
+        staging_dir = os.path.join(settings.MEDIA_ROOT, 'temp')
+        os.makedirs(staging_dir, exist_ok=True)
+        fd, staged_path = tempfile.mkstemp(suffix='.pdf', dir=staging_dir)
+        os.close(fd)
         
         try:
             # Check if user wants visual signature
             add_visual_sign = request.POST.get('visual_sign') == 'on'
+            sign_all_pages = request.POST.get('sign_all_pages') == 'on'
+            # Optional JSON list of {"page", "x", "y", "width", "height", "asset"}
+            placements = None
+            if request.POST.get('placements'):
+                placements = parse_placements(json.loads(request.POST['placements']))
+                add_visual_sign = True
             
             if add_visual_sign:
-                sign_pdf(document.file.path, signature.image.path, output_path)
+                run_cpu(sign_pdf, document.file.path, signature.image.path, staged_path, placements=placements, all_pages=sign_all_pages)
             else:
-                # Just copy the original file if no visual sign needed
-                shutil.copy2(document.file.path, output_path)
+                # The content is unchanged, so share the original's bytes
+                # instead of copying them
+                with stage('link_original'):
+                    os.remove(staged_path)
+                    clone_file(document.file.path, staged_path)
             
-            with open(output_path, 'rb') as f:
-                document.signed_file.save(output_filename, File(f), save=True)
-            
-            document.hash_value = calculate_hash(document.signed_file.path)
+            if not add_visual_sign and document.original_hash:
+                document.hash_value = document.original_hash
+            else:
+                document.hash_value = calculate_hash(staged_path)
             
-            # Cryptographic Signing
+            # Cryptographic Signing, before storing so that a full CPU pool
+            # leaves nothing behind
             if hasattr(request.user, 'key_pair'):
                 user_keys = request.user.key_pair
-                decrypted_private_key = decrypt_private_key(user_keys.private_key)
-                signature = sign_hash(document.hash_value, decrypted_private_key)
-                document.signature_data = signature
+                document.signature_data = run_cpu(_sign_with_key, document.hash_value, user_keys.private_key)
             else:
                  messages.warning(request, 'Document signed visually, but NO cryptographic signature added (No keys found).')
             
+            with stage('store_signed_file'):
+                replaced = document.signed_file.name
+                document.signed_file.save(output_filename, StagedFile(staged_path, sha256=document.hash_value), save=False)
+            
             document.save()
+            # The new file holds a reference of its own, even when its
+            # content is the same blob as the one it replaces
+            delete_on_commit(document.signed_file.storage, replaced)
+            metrics.SIGNINGS.labels(
+                visual=str(add_visual_sign).lower(),
+                cryptographic=str(bool(document.signature_data)).lower(),
+            ).inc()
 
             messages.success(request, 'Document signed successfully.')
             return redirect('dashboard')
+        except Overloaded:
+            raise
         except Exception as e:
+            metrics.SIGNING_ERRORS.inc()
             messages.error(request, f'Error signing document: {e}')
+        finally:
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
             
     return render(request, 'documents/sign.html', {'document': document})
 
-def verify_document(request):
+def _signed_file_response(request, document_id):
+    document = get_object_or_404(Document, id=document_id, user=request.user)
+    if not document.signed_file:
+        raise Http404('This document has not been signed yet.')
+    
+    ext = os.path.splitext(document.signed_file.name)[1]
+    # hash_value is the SHA256 of the signed file, so it makes a strong ETag
+    return serve_file(
+        request,
+        document.signed_file,
+        etag=document.hash_value,
+        last_modified=document.updated_at.timestamp(),
+        filename=f"signed_{document.title}{ext}",
+        asynchronous=True,
+    )
+
+@login_required
+@require_safe
+async def download_document(request, document_id):
+    await resolve_user(request)
+    return await run_blocking(_signed_file_response, request, document_id)
+
+def _check_document_hash(file_hash):
+    """
+    Verification result for a file with SHA256 ``file_hash``: whether a
+    document was signed here with that hash, by whom, and whether its
+    cryptographic signature holds.
+    """
+    try:
+        doc = Document.objects.get(hash_value=file_hash)
+        verification_result = {
+            'valid': True, 
+            'message': f"Document verified! Signed by {doc.user.username} on {doc.updated_at}."
+        }
+        
+        # Verify Cryptographic Signature if present
+        if doc.signature_data and hasattr(doc.user, 'key_pair'):
+            is_valid = run_cpu(verify_signature, file_hash, doc.signature_data, doc.user.key_pair.public_key)
+            if is_valid:
+                verification_result['message'] += " [Valid Cryptographic Signature]"
+            else:
+                verification_result['message'] += " [INVALID Cryptographic Signature]"
+                verification_result['valid'] = False
+        elif doc.signature_data:
+             verification_result['message'] += " [Signed, but public key missing]"
+        else:
+             verification_result['message'] += " [No Cryptographic Signature found]"
+    except Document.DoesNotExist:
+        verification_result = {
+            'valid': False, 
+            'message': "Document hash not found. This document may be invalid or not signed by our platform."
+        }
+    return verification_result
+
+def _verify_upload(request):
     verification_result = None
-    if request.method == 'POST' and 'file' in request.FILES:
-        uploaded_file = request.FILES['file']
+    # Reading FILES parses the body, which fills in request.upload_errors
+    uploaded_file = request.FILES.get('file') if request.method == 'POST' else None
+    if request.upload_errors:
+        verification_result = {
+            'valid': False,
+            'message': ' '.join(request.upload_errors),
+        }
+    elif uploaded_file:
+        metrics.UPLOAD_BYTES.labels(kind='verification').inc(uploaded_file.size)
         
         # Save temp file to calculate hash
         temp_path = os.path.join(settings.MEDIA_ROOT, 'temp', uploaded_file.name)
         os.makedirs(os.path.dirname(temp_path), exist_ok=True)
         
-        with open(temp_path, 'wb+') as destination:
+        with stage('spool_upload'), open(temp_path, 'wb+') as destination:
             for chunk in uploaded_file.chunks():
                 destination.write(chunk)
                 
         file_hash = calculate_hash(temp_path)
         os.remove(temp_path) # Cleanup
         
-        # Check against DB
-        try:
-            doc = Document.objects.get(hash_value=file_hash)
-            verification_result = {
-                'valid': True, 
-                'doc': doc,
-                'message': f"Document verified! Signed by {doc.user.username} on {doc.updated_at}."
-            }
-            
-            # Verify Cryptographic Signature if present
-            if doc.signature_data and hasattr(doc.user, 'key_pair'):
-                is_valid = verify_signature(file_hash, doc.signature_data, doc.user.key_pair.public_key)
-                if is_valid:
-                    verification_result['message'] += " [Valid Cryptographic Signature]"
-                else:
-                    verification_result['message'] += " [INVALID Cryptographic Signature]"
-                    verification_result['valid'] = False
-            elif doc.signature_data:
-                 verification_result['message'] += " [Signed, but public key missing]"
-            else:
-                 verification_result['message'] += " [No Cryptographic Signature found]"
-        except Document.DoesNotExist:
-            verification_result = {
-                'valid': False, 
-                'message': "Document hash not found. This document may be invalid or not signed by our platform."
-            }
+        # Repeat verifications of the same file skip the lookup and the RSA
+        # check until a document or key changes
+        verification_result = cached(
+            'verify_result', [file_hash, documents_version(ALL_DOCUMENTS)],
+            lambda: _check_document_hash(file_hash),
+        )
+        metrics.VERIFICATIONS.labels(result='valid' if verification_result['valid'] else 'invalid').inc()
             
-    return render(request, 'documents/verify.html', {'result': verification_result})
+    return verification_result
+
+@validate_pdf_uploads
+@timed_view('verify_document')
+@replica_reads
+async def verify_document(request):
+    verification_result = await run_blocking(_verify_upload, request)
+    return await run_blocking(render, request, 'documents/verify.html', {'result': verification_result})
+
+
+def metrics_view(request):
+    # Optional shared secret so the endpoint isn't public on an open deployment
+    token = settings.METRICS_TOKEN
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponse(status=401)
+    body, content_type = metrics.render()
+    return HttpResponse(body, content_type=content_type)
 
 
     # views.py
 
 
 @login_required
+@replica_reads
 def api_tokens_view(request):
-    tokens = ApiToken.objects.select_related('user').all().order_by('-created_at')
+    tokens = ApiToken.objects.select_related('user', 'organization').all().order_by('-created_at')
 
     active_count = tokens.filter(expires_at__gt=timezone.now()).count()
     expiring_count = tokens.filter(
@@ -249,7 +493,7 @@ def api_tokens_view(request):
         'active_count': active_count,
         'expiring_count': expiring_count,
         'expired_count': expired_count,
-        'total_count': tokens.count(),
+        'total_count': paginator.count,
         'page_size': 25,
     }
     